@@ -0,0 +1,258 @@
+import os
+import math
+import asyncio
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# OCR/voice jobs running at once across all users (the shared CPU worker budget)
+ADMISSION_GLOBAL_LIMIT = int(os.getenv('ADMISSION_GLOBAL_LIMIT', os.cpu_count() or 1))
+# Jobs one user may run at once
+ADMISSION_USER_LIMIT = int(os.getenv('ADMISSION_USER_LIMIT', 2))
+# Token bucket per user: sustained jobs per second and burst size
+ADMISSION_RATE = float(os.getenv('ADMISSION_RATE', 0.2))
+ADMISSION_BURST = float(os.getenv('ADMISSION_BURST', 10))
+# Longest a job may wait in the queue, in seconds, and most jobs waiting at once
+ADMISSION_MAX_WAIT = float(os.getenv('ADMISSION_MAX_WAIT', 30))
+ADMISSION_MAX_QUEUE = int(os.getenv('ADMISSION_MAX_QUEUE', 100))
+# Fair-queue weights as "user_id=weight,user_id=weight"; users not listed weigh 1
+ADMISSION_WEIGHTS = os.getenv('ADMISSION_WEIGHTS', '')
+
+
+class AdmissionRejected(Exception):
+    """Raised when a job is not admitted; retry_after is a hint in seconds."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self, cost=1.0):
+        """Takes cost tokens; returns 0 on success or the seconds until enough tokens are available."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (cost - self.tokens) / self.rate if self.rate else float('inf')
+
+    def refund(self, cost=1.0):
+        self.tokens = min(self.capacity, self.tokens + cost)
+
+
+class Ticket:
+    def __init__(self, user_id, cost, start, finish):
+        self.user_id = user_id
+        self.cost = cost
+        self.start = start
+        self.finish = finish
+        self.granted = False
+        self.enqueued = time.monotonic()
+        self.started = None
+        self.on_granted = None  # set by waiters that are not woken through the condition
+
+
+class AdmissionController:
+    """
+    Admission control for CPU-bound OCR and voice jobs.
+
+    Each user has a token bucket that limits the rate at which jobs are
+    accepted. Accepted jobs wait in a weighted fair queue (start-time fair
+    queueing): a job's finish tag grows with its user's earlier jobs, so a
+    user with a long batch does not starve users who submit one report.
+    Jobs start in finish-tag order whenever the global limit has room and
+    the user is below the per-user limit.
+    """
+
+    def __init__(self, global_limit, user_limit, rate, burst, max_wait, max_queue, weights=None):
+        self.global_limit = global_limit
+        self.user_limit = user_limit
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.weights = weights or {}
+
+        self._cond = threading.Condition()
+        self._buckets = {}
+        self._running = {}
+        self._running_total = 0
+        self._queue = []  # waiting tickets
+        self._virtual_time = 0.0
+        self._last_finish = {}
+
+        # Metrics
+        self._service_time = 1.0  # moving average of job duration, for Retry-After hints
+        self._waits = deque(maxlen=1000)
+        self._admitted = 0
+        self._rejected = {'rate_limited': 0, 'queue_full': 0, 'wait_timeout': 0}
+
+    @classmethod
+    def from_env(cls):
+        weights = {}
+        for entry in ADMISSION_WEIGHTS.split(','):
+            if '=' in entry:
+                user_id, weight = entry.split('=', 1)
+                weights[user_id.strip()] = float(weight)
+        return cls(ADMISSION_GLOBAL_LIMIT, ADMISSION_USER_LIMIT, ADMISSION_RATE, ADMISSION_BURST,
+                   ADMISSION_MAX_WAIT, ADMISSION_MAX_QUEUE, weights)
+
+    def acquire(self, user_id, cost=1.0):
+        """Blocks until the job may run; raises AdmissionRejected instead of waiting too long."""
+        with self._cond:
+            ticket = self._enqueue(str(user_id), cost)
+            deadline = ticket.enqueued + self.max_wait
+            while not ticket.granted:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._abandon(ticket)
+                    raise AdmissionRejected("The server is busy, please try again shortly", self._estimated_wait())
+                self._cond.wait(remaining)
+            return self._start(ticket)
+
+    async def acquire_async(self, user_id, cost=1.0):
+        """
+        Like acquire, but waits on the event loop instead of a thread, so
+        queued requests do not hold executor threads the running jobs need.
+        """
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            ticket = self._enqueue(str(user_id), cost)
+            if not ticket.granted:
+                granted = loop.create_future()
+                ticket.on_granted = lambda: loop.call_soon_threadsafe(
+                    lambda: granted.done() or granted.set_result(None))
+        try:
+            if not ticket.granted:
+                await asyncio.wait_for(granted, self.max_wait)
+        except asyncio.TimeoutError:
+            with self._cond:
+                if not ticket.granted:
+                    self._abandon(ticket)
+                    raise AdmissionRejected("The server is busy, please try again shortly",
+                                            self._estimated_wait()) from None
+        except asyncio.CancelledError:
+            with self._cond:
+                if not ticket.granted:
+                    self._abandon(ticket, timed_out=False)
+                    raise
+                self._start(ticket)
+            # Granted just as the request went away
+            self.release(ticket)
+            raise
+        with self._cond:
+            return self._start(ticket)
+
+    def _enqueue(self, user_id, cost):
+        """Rate-limits and queues a job, granting it at once when there is room. Caller holds the lock."""
+        bucket = self._buckets.setdefault(user_id, TokenBucket(self.rate, self.burst))
+        wait = bucket.take(cost)
+        if wait:
+            self._rejected['rate_limited'] += 1
+            raise AdmissionRejected("Too many uploads, please slow down", wait)
+        if len(self._queue) >= self.max_queue:
+            bucket.refund(cost)
+            self._rejected['queue_full'] += 1
+            raise AdmissionRejected("The server is busy, please try again shortly", self._estimated_wait())
+
+        start = max(self._virtual_time, self._last_finish.get(user_id, 0.0))
+        ticket = Ticket(user_id, cost, start, start + cost / self.weights.get(user_id, 1.0))
+        self._last_finish[user_id] = ticket.finish
+        self._queue.append(ticket)
+        self._dispatch()
+        return ticket
+
+    def _abandon(self, ticket, timed_out=True):
+        """Drops a job that waited too long or whose request went away. Caller holds the lock."""
+        self._queue.remove(ticket)
+        self._buckets[ticket.user_id].refund(ticket.cost)
+        if timed_out:
+            self._rejected['wait_timeout'] += 1
+
+    def _start(self, ticket):
+        """Records the queue wait of a granted job. Caller holds the lock."""
+        ticket.started = time.monotonic()
+        self._waits.append(ticket.started - ticket.enqueued)
+        self._admitted += 1
+        return ticket
+
+    def release(self, ticket):
+        with self._cond:
+            self._running[ticket.user_id] -= 1
+            if not self._running[ticket.user_id]:
+                del self._running[ticket.user_id]
+            self._running_total -= 1
+            self._service_time = 0.9 * self._service_time + 0.1 * (time.monotonic() - ticket.started)
+            self._dispatch()
+
+    @contextmanager
+    def admit(self, user_id, cost=1.0):
+        ticket = self.acquire(user_id, cost)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def _dispatch(self):
+        """Grant waiting tickets in finish-tag order while there is capacity. Caller holds the lock."""
+        granted = False
+        for ticket in sorted(self._queue, key=lambda t: t.finish):
+            if self._running_total >= self.global_limit:
+                break
+            if self._running.get(ticket.user_id, 0) >= self.user_limit:
+                continue
+            self._queue.remove(ticket)
+            ticket.granted = True
+            self._running[ticket.user_id] = self._running.get(ticket.user_id, 0) + 1
+            self._running_total += 1
+            self._virtual_time = max(self._virtual_time, ticket.start)
+            if ticket.on_granted:
+                ticket.on_granted()
+            granted = True
+        if not self._queue and not self._running_total:
+            # Idle: restart the virtual clock so old finish tags do not penalise anyone
+            self._virtual_time = 0.0
+            self._last_finish.clear()
+        if granted:
+            self._cond.notify_all()
+
+    def _estimated_wait(self):
+        return self._service_time * (len(self._queue) + 1) / self.global_limit
+
+    def metrics(self):
+        with self._cond:
+            waits = sorted(self._waits)
+            return {
+                'running': self._running_total,
+                'queued': len(self._queue),
+                'global_limit': self.global_limit,
+                'user_limit': self.user_limit,
+                'admitted': self._admitted,
+                'rejected': dict(self._rejected),
+                'queue_wait_seconds': {
+                    'p50': waits[len(waits) // 2] if waits else 0.0,
+                    'p95': waits[max(0, math.ceil(len(waits) * 0.95) - 1)] if waits else 0.0,
+                    'max': waits[-1] if waits else 0.0,
+                    'samples': len(waits)
+                }
+            }
+
+
+def retry_after_header(seconds):
+    """Retry-After value in whole seconds (at least 1)."""
+    return str(max(1, math.ceil(seconds)))
+
+
+admission_controller = AdmissionController.from_env()
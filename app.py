@@ -1,9 +1,16 @@
+import io
 import os
+import re
+import csv
 import json
+import hashlib
 import tempfile
 import logging
-from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
+from datetime import datetime, timezone
+import click
+from flask import (Flask, render_template, request, redirect, url_for, flash, jsonify, session, make_response,
+                   Response, stream_with_context)
+from markupsafe import Markup
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
 from bson import ObjectId
@@ -20,16 +27,31 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 
 # Import OCR and voice processing functions
-from ocr_script.ocr_function import extract_text_from_image, parse_lab_report
+from ocr_script.ocr_function import (extract_and_parse_report, get_ocr_tier_stats, is_confident_result,
+                                     PARSER_VERSION)
 from ocr_script.voice_processor import VoiceProcessor
 
 # Import our database and authentication functions
-from database import db, supabase, store_test_result, get_user_test_results
+from database import (db, supabase, store_test_result, get_user_report_ids, get_reports_by_ids,
+                      iter_user_test_results, get_user_trends, get_user_analyte_series,
+                      get_parsed_result_by_digest, store_parsed_result_digest)
+from schema import ensure_indexes
+from fragment_cache import FragmentCache
+from profiling import init_profiling
+from admission import admission_controller, AdmissionRejected, retry_after_header
+from migrations import (backfill_analyte_series, migrate_reports_to_compact, collection_storage_stats,
+                        history_read_bytes)
 from auth import register_user, login_user, logout_user, is_logged_in, get_logged_in_user
 
 app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY', 'your_secret_key')
 
+# Create the MongoDB indexes on startup (idempotent)
+ensure_indexes(db)
+
+# Opt-in sampling profiler (see profiling.py); a no-op unless PROFILING_ENABLED is set
+init_profiling(app)
+
 # Configure upload folder
 UPLOAD_FOLDER = os.path.join(os.getcwd(), 'images')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
@@ -39,6 +61,12 @@ ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'webp'}
 # Initialize voice processor
 voice_processor = VoiceProcessor()
 
+# Rendered result cards of the profile page, keyed by report id (reports never change once stored)
+result_card_cache = FragmentCache(max_entries=int(os.getenv('PROFILE_FRAGMENT_CACHE_SIZE', 5000)))
+
+# User fields shown on the profile page; a change to any of them changes the page's ETag
+PROFILE_FIELDS = ('registration_id', 'name', 'email', 'age', 'gender', 'mobile')
+
 
 # Custom JSON encoder (for API responses)
 class MongoJSONEncoder(json.JSONEncoder):
@@ -57,6 +85,15 @@ def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def file_digest(file_path):
+    """SHA-256 hex digest of a file, matching the digest computed in static/js/main.js."""
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
 def login_required(f):
     def decorated_function(*args, **kwargs):
         if not is_logged_in():
@@ -124,12 +161,142 @@ def logout():
     return redirect(url_for('landing'))
 
 
+def profile_etag(user):
+    """ETag of the profile page: the user's report_version stamp plus the displayed user fields."""
+    fingerprint = json.dumps([user.get('report_version', 0)] + [str(user.get(f)) for f in PROFILE_FIELDS])
+    return hashlib.sha256(fingerprint.encode()).hexdigest()[:32]
+
+
+def render_result_cards(user_id):
+    """Result card fragments for a user's reports, newest first; only uncached reports are fetched."""
+    report_ids = get_user_report_ids(user_id, db)
+    cards = {report_id: result_card_cache.get(str(report_id)) for report_id in report_ids}
+    missing = [report_id for report_id, card in cards.items() if card is None]
+    for report in get_reports_by_ids(missing, db):
+        # Rendered straight from the Jinja environment to skip the per-render context processors
+        card = Markup(app.jinja_env.get_template("_test_result_card.html").render(result=report))
+        result_card_cache.set(str(report['_id']), card)
+        cards[report['_id']] = card
+    return [cards[report_id] for report_id in report_ids if cards[report_id] is not None]
+
+
 @app.route("/profile")
 @login_required
 def profile():
     user = get_logged_in_user(db)
-    test_results = get_user_test_results(user['_id'], db)
-    return render_template("profile.html", user=user, test_results=test_results)
+    etag = profile_etag(user)
+    last_modified = user.get('reports_updated_at')
+    if last_modified:
+        # MongoDB returns naive UTC datetimes
+        last_modified = last_modified.replace(tzinfo=timezone.utc, microsecond=0)
+
+    # Pending flash messages are shown on the page, so it cannot come from the browser cache
+    if '_flashes' not in session:
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains(etag)
+        else:
+            not_modified = (last_modified is not None and request.if_modified_since is not None
+                            and last_modified <= request.if_modified_since)
+        if not_modified:
+            response = make_response('', 304)
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+
+    result_cards = render_result_cards(user['_id'])
+    response = make_response(render_template("profile.html", user=user, result_cards=result_cards))
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+@app.route("/api/trends")
+@login_required
+def trends():
+    """Summary of every analyte tracked for the logged-in user."""
+    series = get_user_trends(session['user_id'], db)
+    return jsonify({'trends': [serialize_series(s) for s in series]})
+
+
+@app.route("/api/trends/<path:analyte>")
+@login_required
+def analyte_trend(analyte):
+    """Chart-ready time series for one analyte of the logged-in user."""
+    series = get_user_analyte_series(session['user_id'], analyte, db)
+    if not series:
+        return jsonify({'error': 'No data for this test'}), 404
+    return jsonify(serialize_series(series))
+
+
+def serialize_series(series):
+    data = {
+        'analyte': series.get('analyte'),
+        'name': series.get('name'),
+        'count': series.get('count', 0),
+        'min': series.get('min'),
+        'max': series.get('max'),
+        'last': series.get('last'),
+        'last_timestamp': series['last_timestamp'].isoformat() if series.get('last_timestamp') else None
+    }
+    if 'points' in series:
+        data['points'] = [
+            {'timestamp': p['timestamp'].isoformat(), 'value': p['value'], 'raw_value': p.get('raw_value')}
+            for p in series['points']
+        ]
+    return data
+
+
+def export_ndjson_rows(reports):
+    for report in reports:
+        yield json.dumps({
+            'report_id': str(report['_id']),
+            'timestamp': report['timestamp'].isoformat(),
+            'source': report.get('source', 'image'),
+            'tests': report.get('test_data', {})
+        }) + '\n'
+
+
+def export_csv_rows(reports):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['report_id', 'timestamp', 'source', 'test', 'value'])
+    for report in reports:
+        for test, value in report.get('test_data', {}).items():
+            writer.writerow([str(report['_id']), report['timestamp'].isoformat(),
+                             report.get('source', 'image'), test, value])
+        # Hand over what this report produced and start the next one with an empty buffer
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+@app.route("/export")
+@login_required
+def export_history():
+    """
+    Stream the logged-in user's report history as NDJSON (one report per line)
+    or CSV (one test value per row). ?since=<ISO timestamp> exports only newer reports.
+    """
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'csv'):
+        return jsonify({'error': 'format must be ndjson or csv'}), 400
+    since = request.args.get('since')
+    if since:
+        try:
+            since = datetime.fromisoformat(since)
+        except ValueError:
+            return jsonify({'error': 'since must be an ISO 8601 timestamp'}), 400
+
+    reports = iter_user_test_results(session['user_id'], db, since=since)
+    if export_format == 'csv':
+        rows, mimetype = export_csv_rows(reports), 'text/csv'
+    else:
+        rows, mimetype = export_ndjson_rows(reports), 'application/x-ndjson'
+    filename = f"test_results.{export_format}"
+    return Response(stream_with_context(rows), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
 
 
 @app.route("/image", methods=["GET", "POST"])
@@ -149,9 +316,12 @@ def image_upload():
             file.save(file_path)
 
             try:
-                # Extract text by OCR and then parse only the test results.
-                extracted_text = extract_text_from_image(file_path)
-                test_results = parse_lab_report(extracted_text)
+                # Extract text by OCR (escalating through the OCR tiers) and parse the test results.
+                with admission_controller.admit(session['user_id']):
+                    text, test_results = extract_and_parse_report(file_path)
+                # Only confident results are reused for identical uploads, so a retry of a poor scan is OCRed again
+                if is_confident_result(text, test_results):
+                    store_parsed_result_digest(file_digest(file_path), test_results, db, PARSER_VERSION)
 
                 # Save the test results using the registration details from the user record.
                 user_id = ObjectId(session['user_id'])
@@ -165,6 +335,8 @@ def image_upload():
                 else:
                     flash("Error storing test results.", "error")
                     return redirect(request.url)
+            except AdmissionRejected:
+                raise
             except Exception as e:
                 logger.error(f"Error processing image: {e}")
                 flash(f"Error processing image: {str(e)}", "error")
@@ -175,6 +347,33 @@ def image_upload():
     return render_template("image_upload.html", user=get_logged_in_user(db))
 
 
+@app.route("/image/digest", methods=["POST"])
+@login_required
+def image_digest():
+    """
+    Pre-upload check: if an upload with this SHA-256 digest was already processed,
+    store its parsed result for the user and render the result page without the
+    image being sent. Answers 204 when the digest is unknown.
+    """
+    digest = request.form.get('digest', '').lower()
+    if not re.fullmatch(r'[0-9a-f]{64}', digest):
+        return jsonify({'error': 'Invalid digest'}), 400
+
+    test_results = get_parsed_result_by_digest(digest, db, PARSER_VERSION)
+    if not test_results or not test_results.get("tests"):
+        return '', 204
+
+    user_id = ObjectId(session['user_id'])
+    mongo_id, supabase_response = store_test_result(user_id, test_results, db, supabase)
+    if not mongo_id:
+        # Let the client fall back to a regular upload
+        return '', 204
+
+    flash("Test results stored successfully!", "success")
+    return render_template("result.html", test_results=test_results.get("tests", {}),
+                           user=get_logged_in_user(db))
+
+
 @app.route("/voice")
 @login_required
 def voice_upload():
@@ -202,7 +401,8 @@ def process_voice():
         logger.info(f"Saved audio file to {temp_file_path} with mime type {mime_type}")
 
         # Process the audio file to extract test results
-        test_results = voice_processor.process_audio_file(temp_file_path, mime_type)
+        with admission_controller.admit(session['user_id']):
+            test_results = voice_processor.process_audio_file(temp_file_path, mime_type)
 
         # Check if there was an error in processing
         if isinstance(test_results, dict) and "error" in test_results:
@@ -226,6 +426,8 @@ def process_voice():
             return render_template("voice_result.html", tests=test_results.get("tests", {}),
                                    user=get_logged_in_user(db))
 
+    except AdmissionRejected:
+        raise
     except Exception as e:
         logger.error(f"Error processing voice: {str(e)}")
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
@@ -244,6 +446,28 @@ def process_voice():
                 logger.error(f"Error removing temporary file: {str(e)}")
 
 
+@app.route("/metrics/ocr")
+def ocr_metrics():
+    """Per-tier OCR hit rates of this worker process."""
+    return jsonify(get_ocr_tier_stats())
+
+
+@app.route("/metrics/admission")
+def admission_metrics():
+    """Running and queued OCR/voice jobs, rejections and queue wait times of this worker process."""
+    return jsonify(admission_controller.metrics())
+
+
+@app.errorhandler(AdmissionRejected)
+def admission_rejected(e):
+    logger.warning(f"Rejected {request.path} for user {session.get('user_id')}: {e}")
+    headers = {'Retry-After': retry_after_header(e.retry_after)}
+    if request.path == url_for('image_upload') and request.headers.get('X-Requested-With') != 'XMLHttpRequest':
+        flash(f"{e}. Try again in {headers['Retry-After']} seconds.", "error")
+        return render_template("image_upload.html", user=get_logged_in_user(db)), 429, headers
+    return jsonify({'error': str(e), 'retry_after': e.retry_after}), 429, headers
+
+
 @app.errorhandler(404)
 def page_not_found(e):
     return render_template('index.html', user=get_logged_in_user(db) if is_logged_in() else None), 404
@@ -256,6 +480,36 @@ def server_error(e):
     return redirect(url_for('landing'))
 
 
+@app.cli.command("backfill-trends")
+@click.option("--user-id", default=None, help="Rebuild the series of a single user only.")
+def backfill_trends_command(user_id):
+    """Rebuild the per-user analyte time series from existing reports."""
+    count = backfill_analyte_series(db, user_id=user_id)
+    click.echo(f"Backfilled analyte series from {count} reports")
+
+
+@app.cli.command("migrate-compact-reports")
+@click.option("--batch-size", default=1000, show_default=True, help="Documents rewritten per batch.")
+@click.option("--skip-supabase", is_flag=True, help="Only rewrite the MongoDB reports.")
+def migrate_compact_reports_command(batch_size, skip_supabase):
+    """Rewrite existing reports to the compact schema and compare sizes before and after."""
+    before = collection_storage_stats(db, "reports")
+    before_read = history_read_bytes(db)
+
+    migrated, cleared = migrate_reports_to_compact(db, None if skip_supabase else supabase, batch_size=batch_size)
+
+    after = collection_storage_stats(db, "reports")
+    after_read = history_read_bytes(db)
+
+    click.echo(f"Compacted {migrated} MongoDB reports, cleared {cleared} Supabase rows")
+    click.echo(f"{'metric':<24}{'before':>14}{'after':>14}")
+    for key in ("count", "size", "avg_obj_size", "storage_size", "total_index_size"):
+        click.echo(f"{key:<24}{before[key]:>14}{after[key]:>14}")
+    click.echo(f"{'history_read_bytes':<24}{before_read:>14}{after_read:>14}")
+    # storage_size may not shrink until the collection is compacted by MongoDB
+    click.echo("Note: storage_size is released by MongoDB only after a compact.")
+
+
 @app.context_processor
 def inject_user():
     """Make current_user available to all templates"""
@@ -0,0 +1,402 @@
+"""
+Asyncio serving mode.
+
+The upload and voice routes are served by a Quart app that waits on MongoDB
+(Motor), Supabase (async client) and FFmpeg (asyncio subprocess) without
+holding a thread, while OCR runs on a process pool. The app also serves the
+live dictation WebSocket at /ws/voice. Every other route is passed through
+to the synchronous Flask app. Run it with:
+
+    uvicorn asgi:application --workers 4
+"""
+import os
+import asyncio
+import logging
+import tempfile
+from collections import Counter
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
+import speech_recognition as sr
+from quart import (Quart, render_template, request, redirect, url_for, flash, jsonify, session, abort,
+                   websocket)
+from werkzeug.utils import secure_filename
+from asgiref.wsgi import WsgiToAsgi
+from bson import ObjectId
+
+from app import app, allowed_file, file_digest, voice_processor
+from admission import admission_controller, AdmissionRejected, retry_after_header, ADMISSION_GLOBAL_LIMIT
+from async_database import db, get_supabase, get_user_by_id, store_test_result, store_parsed_result_digest
+from ocr_script.ocr_function import run_tiered_ocr, record_ocr_tier, is_confident_result, PARSER_VERSION
+from ocr_script.voice_processor import (needs_conversion, ffmpeg_command, ffmpeg_stream_command,
+                                        cleanup_temp_files, VOICE_MAX_SEGMENT_SECONDS)
+from ocr_script.audio_segmentation import SilenceSegmenter
+
+logger = logging.getLogger(__name__)
+
+quart_app = Quart(__name__)
+quart_app.secret_key = app.secret_key
+quart_app.config['UPLOAD_FOLDER'] = app.config['UPLOAD_FOLDER']
+
+# CPU-bound OCR runs in separate processes so it never blocks the event loop
+ocr_executor = ProcessPoolExecutor(max_workers=int(os.getenv('OCR_WORKERS', os.cpu_count() or 1)))
+
+# Sample rate the live dictation stream is decoded to
+STREAM_SAMPLE_RATE = 16000
+# Bytes of PCM read from FFmpeg at a time (one second of audio)
+STREAM_READ_BYTES = STREAM_SAMPLE_RATE * 2
+
+# Limits of the live dictation stream: total length and longest gap between chunks in
+# seconds (the client sends a chunk every second), and concurrent streams per user and in
+# total; each stream runs an FFmpeg process, so by default they share the admission budget
+VOICE_STREAM_MAX_SECONDS = float(os.getenv('VOICE_STREAM_MAX_SECONDS', 600))
+VOICE_STREAM_IDLE_SECONDS = float(os.getenv('VOICE_STREAM_IDLE_SECONDS', 15))
+VOICE_STREAM_USER_LIMIT = int(os.getenv('VOICE_STREAM_USER_LIMIT', 1))
+VOICE_STREAM_GLOBAL_LIMIT = int(os.getenv('VOICE_STREAM_GLOBAL_LIMIT', ADMISSION_GLOBAL_LIMIT))
+
+# Open live voice streams per user id (only touched from the event loop)
+active_streams = Counter()
+
+# (path, method) pairs served by the async app; everything else goes to Flask
+ASYNC_ROUTES = {("/image", "POST"), ("/process_voice", "POST")}
+
+
+def login_required(f):
+    async def decorated_function(*args, **kwargs):
+        if 'user_id' not in session:
+            await flash('Please log in to access this page', 'warning')
+            return redirect(url_for('login'))
+        return await f(*args, **kwargs)
+
+    decorated_function.__name__ = f.__name__
+    return decorated_function
+
+
+async def convert_to_wav(audio_file_path, temp_files):
+    """Convert an audio file to WAV with an FFmpeg subprocess awaited on the event loop."""
+    wav_file = tempfile.NamedTemporaryFile(delete=False, suffix='.wav')
+    wav_file.close()
+    temp_files.append(wav_file.name)
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *ffmpeg_command(audio_file_path, wav_file.name),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        _, stderr = await process.communicate()
+        if process.returncode != 0:
+            logger.error(f"FFmpeg conversion failed: {stderr.decode(errors='replace')[-500:]}")
+            return audio_file_path
+        return wav_file.name
+    except FileNotFoundError as e:
+        logger.error(f"FFmpeg conversion failed: {e}")
+        return audio_file_path
+
+
+@asynccontextmanager
+async def admitted(user_id):
+    """Waits for an admission ticket on the event loop and releases it afterwards."""
+    ticket = await admission_controller.acquire_async(user_id)
+    try:
+        yield ticket
+    finally:
+        admission_controller.release(ticket)
+
+
+@quart_app.route("/image", methods=["POST"], endpoint="image_upload")
+@login_required
+async def image_upload():
+    files = await request.files
+    if 'image' not in files:
+        await flash("No file part", "error")
+        return redirect(request.url)
+    file = files["image"]
+    if file.filename == "":
+        await flash("No file selected", "error")
+        return redirect(request.url)
+    if not allowed_file(file.filename):
+        await flash("Invalid file type. Please upload a supported image file.", "error")
+        return redirect(request.url)
+
+    filename = secure_filename(file.filename)
+    file_path = os.path.join(quart_app.config["UPLOAD_FOLDER"], filename)
+    await file.save(file_path)
+
+    try:
+        loop = asyncio.get_running_loop()
+        async with admitted(session['user_id']):
+            text, test_results, tier_name = await loop.run_in_executor(ocr_executor, run_tiered_ocr, file_path)
+        record_ocr_tier(tier_name)
+        if is_confident_result(text, test_results):
+            await store_parsed_result_digest(file_digest(file_path), test_results, db, PARSER_VERSION)
+
+        user_id = ObjectId(session['user_id'])
+        mongo_id, supabase_response = await store_test_result(user_id, test_results, db, await get_supabase())
+
+        if mongo_id:
+            await flash("Test results stored successfully!", "success")
+            return await render_template("result.html", test_results=test_results.get("tests", {}),
+                                         user=await get_user_by_id(user_id, db))
+        await flash("Error storing test results.", "error")
+        return redirect(request.url)
+    except AdmissionRejected:
+        raise
+    except Exception as e:
+        logger.error(f"Error processing image: {e}")
+        await flash(f"Error processing image: {str(e)}", "error")
+        return redirect(request.url)
+
+
+@quart_app.route("/process_voice", methods=["POST"], endpoint="process_voice")
+@login_required
+async def process_voice():
+    files = await request.files
+    form = await request.form
+    is_xhr = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+    if 'audio' not in files:
+        return jsonify({'error': 'No audio file provided'}), 400
+
+    audio_file = files['audio']
+    mime_type = form.get('mime_type', 'audio/webm')
+    extension = audio_file.filename.split('.')[-1] if '.' in audio_file.filename else 'webm'
+
+    temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=f'.{extension}')
+    temp_file.close()
+    temp_files = [temp_file.name]
+
+    try:
+        await audio_file.save(temp_file.name)
+        logger.info(f"Saved audio file to {temp_file.name} with mime type {mime_type}")
+
+        async with admitted(session['user_id']):
+            audio_path = temp_file.name
+            if needs_conversion(audio_path):
+                audio_path = await convert_to_wav(audio_path, temp_files)
+
+            # Recognition is a blocking HTTP call inside SpeechRecognition, spaCy is CPU-bound
+            loop = asyncio.get_running_loop()
+            test_results = await loop.run_in_executor(None, voice_processor.recognize_file, audio_path)
+
+        if isinstance(test_results, dict) and "error" in test_results:
+            await flash(test_results["error"], "error")
+            return redirect(url_for('voice_upload'))
+
+        user_id = ObjectId(session['user_id'])
+        mongo_id, supabase_response = await store_test_result(user_id, test_results, db, await get_supabase())
+
+        if mongo_id:
+            await flash("Voice test results stored successfully!", "success")
+        else:
+            await flash("Error storing voice test results.", "error")
+            return redirect(url_for('voice_upload'))
+
+        if is_xhr:
+            return jsonify({'success': True, 'test_results': test_results.get("tests", {})})
+        return await render_template("voice_result.html", tests=test_results.get("tests", {}),
+                                     user=await get_user_by_id(user_id, db))
+
+    except AdmissionRejected:
+        raise
+    except Exception as e:
+        logger.error(f"Error processing voice: {str(e)}")
+        if is_xhr:
+            return jsonify({'error': str(e)}), 500
+        await flash(f"Error processing voice: {str(e)}", "error")
+        return redirect(url_for('voice_upload'))
+
+    finally:
+        cleanup_temp_files(temp_files)
+
+
+@quart_app.websocket("/ws/voice")
+async def voice_stream():
+    """
+    Live dictation. The client sends MediaRecorder chunks as binary messages and
+    the text message "stop" when the user stops talking. The audio is piped
+    through one FFmpeg process into the silence segmenter; each finished segment
+    is recognized right away and a "partial" message with the transcript and
+    measurements so far is pushed back. After "stop" only the last segment is
+    left to recognize before the "final" message.
+
+    A user may hold VOICE_STREAM_USER_LIMIT streams at once and the process
+    VOICE_STREAM_GLOBAL_LIMIT; refused clients upload instead. A stream is
+    finished after VOICE_STREAM_MAX_SECONDS and dropped when no message
+    arrives for VOICE_STREAM_IDLE_SECONDS.
+    """
+    if 'user_id' not in session:
+        await websocket.close(1008)
+        return
+    user_id = session['user_id']
+    if active_streams[user_id] >= VOICE_STREAM_USER_LIMIT:
+        # The client falls back to uploading the recording, which goes through admission control
+        logger.warning(f"User {user_id} already has {active_streams[user_id]} live voice streams")
+        await websocket.close(1013)
+        return
+    if sum(active_streams.values()) >= VOICE_STREAM_GLOBAL_LIMIT:
+        logger.warning(f"{VOICE_STREAM_GLOBAL_LIMIT} live voice streams already open, refusing another")
+        await websocket.close(1013)
+        return
+    active_streams[user_id] += 1
+    try:
+        await websocket.accept()
+        await stream_dictation()
+    finally:
+        active_streams[user_id] -= 1
+        if not active_streams[user_id]:
+            del active_streams[user_id]
+
+
+async def stream_dictation():
+    """Runs one accepted live dictation stream (see voice_stream)."""
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    recognizer = sr.Recognizer()
+    segmenter = SilenceSegmenter(STREAM_SAMPLE_RATE, energy_threshold=recognizer.energy_threshold,
+                                 max_segment_s=VOICE_MAX_SEGMENT_SECONDS)
+    recognitions = []  # one task per segment, in spoken order
+    send_lock = asyncio.Lock()
+
+    process = await asyncio.create_subprocess_exec(
+        *ffmpeg_stream_command(STREAM_SAMPLE_RATE),
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL
+    )
+
+    def transcript_so_far():
+        texts = []
+        for task in recognitions:
+            if not task.done() or task.exception():
+                break
+            texts.append(task.result())
+        return " ".join(t for t in texts if t)
+
+    async def publish_partial():
+        text = transcript_so_far()
+        if not text:
+            return
+        try:
+            tests = await loop.run_in_executor(None, voice_processor.extract_medical_measurements, text)
+            async with send_lock:
+                await websocket.send_json({'type': 'partial', 'transcript': text, 'tests': tests})
+        except Exception as e:
+            logger.info(f"Could not publish partial transcript: {e}")
+
+    def on_recognized(task):
+        if not task.cancelled() and task.exception() is None:
+            asyncio.ensure_future(publish_partial())
+
+    def recognize(segment):
+        audio = sr.AudioData(segment, STREAM_SAMPLE_RATE, 2)
+        task = asyncio.ensure_future(loop.run_in_executor(
+            voice_processor.recognition_pool, voice_processor.recognize_segment, recognizer, audio))
+        task.add_done_callback(on_recognized)
+        recognitions.append(task)
+
+    async def read_pcm():
+        while True:
+            pcm = await process.stdout.read(STREAM_READ_BYTES)
+            if not pcm:
+                break
+            for segment in segmenter.feed(pcm):
+                recognize(segment)
+        for segment in segmenter.flush():
+            recognize(segment)
+
+    reader = asyncio.ensure_future(read_pcm())
+    try:
+        while True:
+            remaining = started + VOICE_STREAM_MAX_SECONDS - loop.time()
+            if remaining <= 0:
+                logger.info("Live voice stream reached its maximum length, finishing it")
+                break
+            try:
+                message = await asyncio.wait_for(websocket.receive(), min(VOICE_STREAM_IDLE_SECONDS, remaining))
+            except asyncio.TimeoutError:
+                if loop.time() - started >= VOICE_STREAM_MAX_SECONDS:
+                    continue
+                logger.info(f"Live voice stream idle for {VOICE_STREAM_IDLE_SECONDS} s, closing it")
+                await websocket.send_json({'type': 'error', 'error': "The live dictation timed out."})
+                return
+            if isinstance(message, bytes):
+                process.stdin.write(message)
+                await process.stdin.drain()
+            elif message == "stop":
+                break
+        process.stdin.close()
+        await reader
+        if not recognitions:
+            # Too quiet for the segmenter; closing without a "final" message makes the
+            # client upload the recording, which is recognized as a whole
+            logger.info("No speech segments in the live stream, leaving it to the upload")
+            return
+
+        try:
+            texts = await asyncio.gather(*recognitions)
+        except sr.RequestError as e:
+            logger.error(f"Could not request results from Google Speech Recognition service: {e}")
+            await websocket.send_json({'type': 'error', 'error': f"Speech recognition service error: {str(e)}"})
+            return
+        text = " ".join(t for t in texts if t)
+        if not text:
+            await websocket.send_json({'type': 'error',
+                                       'error': "Could not understand the audio. Please speak clearly and try again."})
+            return
+
+        logger.info(f"Recognized streamed text: {text}")
+        tests = await loop.run_in_executor(None, voice_processor.extract_medical_measurements, text)
+        test_results = {"tests": tests, "source": "voice"}
+
+        user_id = ObjectId(session['user_id'])
+        mongo_id, supabase_response = await store_test_result(user_id, test_results, db, await get_supabase())
+        if not mongo_id:
+            await websocket.send_json({'type': 'error', 'error': "Error storing voice test results."})
+            return
+
+        html = await render_template("voice_result.html", tests=tests, user=await get_user_by_id(user_id, db))
+        async with send_lock:
+            await websocket.send_json({'type': 'final', 'transcript': text, 'tests': tests, 'html': html})
+    finally:
+        reader.cancel()
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+
+
+@quart_app.context_processor
+async def inject_user():
+    """Make current_user available to all templates"""
+    if 'user_id' in session:
+        return {'current_user': await get_user_by_id(session['user_id'], db)}
+    return {'current_user': None}
+
+
+@quart_app.errorhandler(AdmissionRejected)
+async def admission_rejected(e):
+    logger.warning(f"Rejected {request.path} for user {session.get('user_id')}: {e}")
+    headers = {'Retry-After': retry_after_header(e.retry_after)}
+    if request.path == url_for('image_upload') and request.headers.get('X-Requested-With') != 'XMLHttpRequest':
+        await flash(f"{e}. Try again in {headers['Retry-After']} seconds.", "error")
+        return await render_template("image_upload.html", user=await get_user_by_id(session['user_id'], db)), \
+            429, headers
+    return jsonify({'error': str(e), 'retry_after': e.retry_after}), 429, headers
+
+
+async def served_by_flask(**kwargs):
+    abort(404)
+
+
+# Mirror the Flask endpoints so url_for() in the shared templates can build them
+for rule in app.url_map.iter_rules():
+    if rule.endpoint not in quart_app.view_functions:
+        quart_app.add_url_rule(rule.rule, endpoint=rule.endpoint, view_func=served_by_flask,
+                               methods=list(rule.methods))
+
+wsgi_application = WsgiToAsgi(app)
+
+
+async def application(scope, receive, send):
+    """ASGI entry point dispatching between the async routes and the Flask app."""
+    if scope["type"] == "http" and (scope["path"], scope["method"]) not in ASYNC_ROUTES:
+        await wsgi_application(scope, receive, send)
+    else:
+        await quart_app(scope, receive, send)
@@ -0,0 +1,95 @@
+import logging
+from datetime import datetime
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+from motor.motor_asyncio import AsyncIOMotorClient
+from supabase import acreate_client, AsyncClient
+from database import (MONGO_URI, DB_NAME, SUPABASE_URL, SUPABASE_API_KEY, build_test_result_document,
+                      build_analyte_series_updates, build_report_version_update, build_supabase_report_row,
+                      build_parsed_result_digest_update)
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# --- MongoDB Atlas Configuration (asyncio driver) ---
+client = AsyncIOMotorClient(MONGO_URI)
+db = client[DB_NAME]
+
+# --- Supabase Configuration (async client, created on first use) ---
+_supabase: AsyncClient = None
+
+
+async def get_supabase():
+    """Return the shared async Supabase client, creating it inside the running event loop."""
+    global _supabase
+    if _supabase is None:
+        _supabase = await acreate_client(SUPABASE_URL, SUPABASE_API_KEY)
+    return _supabase
+
+
+async def get_user_by_id(user_id, mongo_db):
+    """Retrieve a user by their ID from MongoDB."""
+    try:
+        if isinstance(user_id, str):
+            user_id = ObjectId(user_id)
+        return await mongo_db.users.find_one({"_id": user_id})
+    except Exception as e:
+        logger.error(f"Error retrieving user by ID: {e}")
+        return None
+
+
+async def store_test_result(user_id, test_data, mongo_db, supabase):
+    """Async counterpart of database.store_test_result."""
+    try:
+        user = await get_user_by_id(user_id, mongo_db)
+        if not user:
+            logger.error(f"User not found with ID: {user_id}")
+            return None, None
+
+        test_result = build_test_result_document(user_id, test_data)
+
+        mongo_result = await mongo_db.reports.insert_one(test_result)
+        logger.info(f"Test result stored in MongoDB with ID: {mongo_result.inserted_id}")
+
+        updates = build_analyte_series_updates(user_id, test_result["test_data"], test_result["timestamp"],
+                                               mongo_result.inserted_id)
+        if updates:
+            try:
+                await mongo_db.analyte_series.bulk_write(updates, ordered=False)
+            except Exception as e:
+                logger.error(f"Error updating analyte series: {e}")
+
+        try:
+            await mongo_db.users.update_one({"_id": user["_id"]}, build_report_version_update())
+        except Exception as e:
+            logger.error(f"Error updating report version: {e}")
+
+        supabase_data = build_supabase_report_row(test_result)
+
+        supabase_user = await supabase.table("users").select("id").eq("registration_id",
+                                                                      user.get("registration_id")).execute()
+        if not supabase_user.data:
+            logger.error(f"User not found in Supabase with registration_id: {user.get('registration_id')}")
+            return mongo_result.inserted_id, None
+
+        supabase_data['user_id'] = supabase_user.data[0]['id']
+
+        supabase_response = await supabase.table("test_results").insert(supabase_data).execute()
+        logger.info("Test result stored in Supabase")
+
+        return mongo_result.inserted_id, supabase_response.data
+    except Exception as e:
+        logger.error(f"Error storing test result: {e}")
+        return None, None
+
+
+async def store_parsed_result_digest(digest, parsed, mongo_db, parser_version):
+    """Async counterpart of database.store_parsed_result_digest."""
+    try:
+        await mongo_db.report_digests.update_one(
+            *build_parsed_result_digest_update(digest, parsed, parser_version, datetime.now()), upsert=True)
+    except DuplicateKeyError:
+        pass
+    except Exception as e:
+        logger.error(f"Error storing parsed result digest: {e}")
@@ -4,13 +4,19 @@ import uuid
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask import session
 from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
 from database import get_user_by_email, create_user, get_user_by_id
+from schema import has_index
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 
+# Attempts at inserting a new user when its generated registration ID is already taken
+REGISTRATION_ATTEMPTS = 3
+
+
 def generate_registration_id(db_collection):
     """Generate a unique registration ID in the format MRO1, MRO2, etc."""
     try:
@@ -19,7 +25,17 @@ def generate_registration_id(db_collection):
     except Exception as e:
         logger.error(f"Error generating registration ID: {e}")
         # Fallback to a timestamp-based ID if counting fails
-        return f"MRO{int(uuid.uuid4().hex[:6], 16)}"
+        return random_registration_id()
+
+
+def random_registration_id():
+    return f"MRO{int(uuid.uuid4().hex[:6], 16)}"
+
+
+def is_duplicate_email(error):
+    """Whether a DuplicateKeyError was raised by the unique email index."""
+    key_pattern = (error.details or {}).get("keyPattern", {})
+    return "email" in key_pattern or "email_unique" in str(error)
 
 
 def validate_email(email):
@@ -66,10 +82,6 @@ def prepare_user_for_supabase(user_data):
 
 def register_user(name, email, age, gender, mobile, password, mongo_db, supabase):
     try:
-        existing_user = get_user_by_email(email, mongo_db)
-        if existing_user:
-            return False, "Email already registered"
-
         if not validate_email(email):
             return False, "Invalid email format"
 
@@ -80,11 +92,9 @@ def register_user(name, email, age, gender, mobile, password, mongo_db, supabase
         if not validate_mobile(mobile):
             return False, "Invalid mobile number format"
 
-        reg_id = generate_registration_id(mongo_db.users)
         hashed_password = generate_password_hash(password)
 
         user_data = {
-            "registration_id": reg_id,
             "name": name,
             "email": email,
             "age": int(age),
@@ -93,8 +103,24 @@ def register_user(name, email, age, gender, mobile, password, mongo_db, supabase
             "password": hashed_password
         }
 
-        # Insert into MongoDB
-        mongo_result = create_user(user_data, mongo_db)
+        # The unique email index (see schema.py) rejects duplicates on insert; look the
+        # email up first only when the index is missing, e.g. it failed over existing duplicates
+        if not has_index(mongo_db.users, "email_unique") and get_user_by_email(email, mongo_db):
+            return False, "Email already registered"
+
+        # Insert into MongoDB; the unique registration_id index rejects a taken ID
+        mongo_result = None
+        for attempt in range(REGISTRATION_ATTEMPTS):
+            reg_id = generate_registration_id(mongo_db.users) if attempt == 0 else random_registration_id()
+            user_data["registration_id"] = reg_id
+            user_data.pop("_id", None)
+            try:
+                mongo_result = create_user(user_data, mongo_db)
+                break
+            except DuplicateKeyError as e:
+                if is_duplicate_email(e):
+                    return False, "Email already registered"
+                logger.info(f"Registration ID {reg_id} already taken, generating another")
         if not mongo_result:
             return False, "Error creating user in MongoDB"
 
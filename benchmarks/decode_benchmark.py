@@ -0,0 +1,90 @@
+"""
+Compare full-resolution decoding with load_image_for_ocr.
+
+Each measurement runs in a fresh interpreter whose RSS high-water mark is reset
+after the imports, so the peak reflects that decode alone (Linux only). Usage:
+
+    python benchmarks/decode_benchmark.py images/7.jpg images/imgpsh_fullsize_anim.png --synthetic
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MEASURE = r'''
+import sys, time, json
+sys.path.insert(0, {root!r})
+from PIL import Image
+from ocr_script.ocr_function import load_image_for_ocr
+
+def peak_rss_kb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+
+# Reset the high-water mark so that imports do not count towards the peak
+with open("/proc/self/clear_refs", "w") as f:
+    f.write("5")
+baseline = peak_rss_kb()
+start = time.perf_counter()
+if {mode!r} == "full":
+    image = Image.open({path!r})
+    image.load()
+else:
+    image = load_image_for_ocr({path!r})
+    image.load()
+elapsed = time.perf_counter() - start
+peak = peak_rss_kb()
+print(json.dumps({{"size": image.size, "seconds": elapsed, "peak_kb": peak, "delta_kb": peak - baseline}}))
+'''
+
+
+def measure(path, mode):
+    code = MEASURE.format(root=ROOT, path=path, mode=mode)
+    output = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True).stdout
+    return json.loads(output)
+
+
+def make_synthetic_jpeg(source, size=(4000, 3000)):
+    """Upscale a sample report to a typical phone-camera resolution."""
+    from PIL import Image
+    target = tempfile.NamedTemporaryFile(delete=False, suffix=".jpg")
+    target.close()
+    Image.open(source).convert("RGB").resize(size).save(target.name, quality=90)
+    return target.name
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--synthetic", action="store_true",
+                        help="Also measure a 4000x3000 JPEG generated from the first path.")
+    args = parser.parse_args()
+
+    paths = list(args.paths)
+    synthetic = None
+    if args.synthetic:
+        synthetic = make_synthetic_jpeg(paths[0])
+        paths.append(synthetic)
+
+    try:
+        print(f"{'image':<40}{'mode':<8}{'decoded size':<16}{'ms':>8}{'peak RSS MB':>14}{'delta MB':>10}")
+        for path in paths:
+            label = "synthetic 4000x3000 JPEG" if path == synthetic else os.path.relpath(path)
+            for mode in ("full", "ocr"):
+                result = measure(os.path.abspath(path), mode)
+                size = "x".join(str(v) for v in result["size"])
+                print(f"{label:<40}{mode:<8}{size:<16}{result['seconds'] * 1000:>8.1f}"
+                      f"{result['peak_kb'] / 1024:>14.1f}{result['delta_kb'] / 1024:>10.1f}")
+    finally:
+        if synthetic:
+            os.unlink(synthetic)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Login lookup latency (get_user_by_email) against user count, with and without
+the indexes from schema.ensure_indexes.
+
+Runs against MONGO_URI in a scratch database that is dropped afterwards:
+
+    python benchmarks/login_benchmark.py --counts 1000 10000 100000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+from pymongo import MongoClient
+
+from schema import ensure_indexes
+
+load_dotenv()
+
+
+def seed_users(collection, count, batch_size=10000):
+    for start in range(0, count, batch_size):
+        collection.insert_many([
+            {"registration_id": f"MRO{i + 1}", "email": f"user{i}@example.com", "name": f"User {i}"}
+            for i in range(start, min(start + batch_size, count))
+        ], ordered=False)
+
+
+def time_lookups(collection, count, lookups):
+    samples = []
+    for _ in range(lookups):
+        email = f"user{random.randrange(count)}@example.com"
+        start = time.perf_counter()
+        collection.find_one({"email": email})
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.95) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--counts", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--lookups", type=int, default=200)
+    parser.add_argument("--db-name", default="ocr_login_benchmark")
+    args = parser.parse_args()
+
+    client = MongoClient(os.getenv("MONGO_URI"))
+    print(f"{'users':>10}{'scan p50 ms':>14}{'scan p95 ms':>14}{'index p50 ms':>14}{'index p95 ms':>14}")
+    try:
+        for count in args.counts:
+            client.drop_database(args.db_name)
+            db = client[args.db_name]
+            seed_users(db.users, count)
+            scan = time_lookups(db.users, count, args.lookups)
+            ensure_indexes(db)
+            indexed = time_lookups(db.users, count, args.lookups)
+            print(f"{count:>10}{scan[0]:>14.2f}{scan[1]:>14.2f}{indexed[0]:>14.2f}{indexed[1]:>14.2f}")
+    finally:
+        client.drop_database(args.db_name)
+
+
+if __name__ == "__main__":
+    main()
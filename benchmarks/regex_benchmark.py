@@ -0,0 +1,53 @@
+"""
+Parse time of parse_lab_report on adversarial OCR output.
+
+Each case is generated at growing sizes; with bounded parsing the time grows
+linearly with the input and stays far below OCR_PARSE_TIME_BUDGET. Set
+OCR_REGEX_ENGINE=re2 to measure the RE2 engine.
+
+    python benchmarks/regex_benchmark.py --scales 1 2 4 8
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ocr_script import regex_engine
+from ocr_script.ocr_function import parse_lab_report
+
+# name -> function building the input at a given scale (about 20k characters at scale 1)
+CASES = {
+    "whitespace run after name label": lambda n: "PATIENT NAME :" + " " * 20000 * n + "y",
+    "repeated name labels, no SEX/Age": lambda n: ("PATIENT NAME : x" + " " * 50) * 300 * n,
+    "long name without terminator": lambda n: "PATIENT NAME : " + "A " * 10000 * n + "\n",
+    "punctuation run after Name": lambda n: "Name: " + "., " * 7000 * n + "!",
+    "Name lines without Patient ID": lambda n: ("Name " + "a " * 200 + "\n") * 50 * n,
+    "letter lines without Sample Collected": lambda n: ("Ab " * 300 + "\n") * 22 * n,
+    "Age/Sex separators without sex": lambda n: ("Age/Sex " + " /" * 2000 + "\n") * 5 * n,
+    "tab and newline noise in test section": lambda n: "CBC\n" + ("\t \n \t" * 4000 + "Hb 12\n") * n,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+
+    print(f"Regex engine: {regex_engine.engine.__name__}")
+    print(f"{'case':<40}{'chars':>10}{'ms':>10}")
+    worst = 0.0
+    for name, build in CASES.items():
+        for scale in args.scales:
+            text = build(scale)
+            start = time.perf_counter()
+            parse_lab_report(text, time_budget=0)
+            elapsed = (time.perf_counter() - start) * 1000
+            worst = max(worst, elapsed)
+            print(f"{name:<40}{len(text):>10}{elapsed:>10.1f}")
+    print(f"Worst case: {worst:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""
+Bulk importer for archives of report images.
+
+Files are mapped to users either by a manifest CSV with a "path" column and
+an "email" or "registration_id" column (plus an optional ISO "date" column
+giving the date of each report; reports without one are dated at import
+time), or by a directory whose
+subdirectories are named after the users' registration id or email (or a
+flat directory plus --user). OCR and parsing run on a process pool and the
+results are written to MongoDB and Supabase in batches. Every file that is
+written (or fails) is appended to a checkpoint file, so an interrupted run
+started again with the same arguments skips the completed files.
+
+    python bulk_import.py --dir archive/ --workers 8
+    python bulk_import.py --manifest clinic.csv --checkpoint clinic.checkpoint
+"""
+import os
+import csv
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+from ocr_script.ocr_function import run_tiered_ocr, is_confident_result, PARSER_VERSION
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.webp'}
+
+
+def process_file(path):
+    """OCR and parse one file in a worker process. Returns (path, digest, parsed, confident, error)."""
+    try:
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        text, parsed, _ = run_tiered_ocr(path)
+        return path, digest, parsed, is_confident_result(text, parsed), None
+    except Exception as e:
+        return path, None, None, False, str(e)
+
+
+def parse_report_date(value):
+    """Parse an ISO date or date-time from the manifest; empty means undated."""
+    if not value or not value.strip():
+        return None
+    return datetime.fromisoformat(value.strip())
+
+
+def files_from_manifest(manifest_path):
+    """Yield (path, user_key, date) triples from a manifest CSV; relative paths are resolved against its folder."""
+    base = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path, newline='') as f:
+        for line, row in enumerate(csv.DictReader(f), start=2):
+            user_key = row.get('email') or row.get('registration_id')
+            try:
+                date = parse_report_date(row.get('date'))
+            except ValueError:
+                raise ValueError(f"{manifest_path}:{line}: invalid date '{row['date']}'")
+            yield os.path.join(base, row['path']), user_key, date
+
+
+def files_from_directory(root, user_key=None):
+    """Yield (path, user_key, None) triples; without user_key the first subdirectory names the user."""
+    for dirpath, _, filenames in os.walk(root):
+        for filename in sorted(filenames):
+            if os.path.splitext(filename)[1].lower() not in IMAGE_EXTENSIONS:
+                continue
+            path = os.path.join(dirpath, filename)
+            if user_key:
+                yield path, user_key, None
+            else:
+                relative = os.path.relpath(path, root).split(os.sep)
+                if len(relative) > 1:
+                    yield path, relative[0], None
+                else:
+                    logger.warning(f"Skipping {path}: not inside a user directory")
+
+
+def load_checkpoint(checkpoint_path):
+    """Paths already written by earlier runs."""
+    done = set()
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry['status'] == 'done':
+                    done.add(entry['path'])
+    return done
+
+
+def append_checkpoint(checkpoint_file, entries):
+    for path, status, error in entries:
+        checkpoint_file.write(json.dumps({'path': path, 'status': status, 'error': error}) + '\n')
+    checkpoint_file.flush()
+    os.fsync(checkpoint_file.fileno())
+
+
+def resolve_users(user_keys, mongo_db):
+    """Map each email or registration id to its user document with one query."""
+    keys = list(user_keys)
+    users = mongo_db.users.find({'$or': [{'email': {'$in': keys}}, {'registration_id': {'$in': keys}}]})
+    resolved = {}
+    for user in users:
+        resolved[user.get('email')] = user
+        resolved[user.get('registration_id')] = user
+    return {key: resolved[key] for key in keys if key in resolved}
+
+
+class Progress:
+    """Logs throughput and ETA at most every interval seconds."""
+
+    def __init__(self, total, interval=5.0):
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.started = time.monotonic()
+        self.last_report = 0.0
+
+    def advance(self, count=1, force=False):
+        self.done += count
+        now = time.monotonic()
+        if not force and now - self.last_report < self.interval:
+            return
+        self.last_report = now
+        elapsed = now - self.started
+        rate = self.done / elapsed if elapsed else 0.0
+        remaining = (self.total - self.done) / rate if rate else float('inf')
+        eta = time.strftime('%H:%M:%S', time.gmtime(remaining)) if remaining != float('inf') else '--:--:--'
+        logger.info(f"{self.done}/{self.total} files, {rate:.2f} files/s, ETA {eta}")
+
+
+def run_import(files, checkpoint_path, workers, batch_size):
+    # Imported here so the spawned worker processes do not open database connections
+    from database import db, supabase, store_test_results_batch, store_parsed_result_digests
+    from schema import ensure_indexes
+
+    done = load_checkpoint(checkpoint_path)
+    pending = [(path, key, date) for path, key, date in files if path not in done]
+    logger.info(f"{len(done)} files already imported, {len(pending)} to go")
+    if not pending:
+        return
+
+    # Replayed batches are matched on import_key, which needs its index to stay fast
+    ensure_indexes(db)
+
+    users = resolve_users({key for _, key, _ in pending}, db)
+    unknown = {key for _, key, _ in pending if key not in users}
+    for key in unknown:
+        logger.error(f"No user with email or registration id '{key}', skipping its files")
+    pending = [(path, key, date) for path, key, date in pending if key in users]
+    user_for_path = {path: key for path, key, _ in pending}
+    date_for_path = {path: date for path, _, date in pending}
+
+    progress = Progress(len(pending))
+    batch, digests, checkpoint_entries, key_paths = [], {}, [], {}
+
+    def flush():
+        # Reports that could not be written to Supabase stay failed so the next run retries them
+        unsynced = {key_paths[key] for key in store_test_results_batch(batch, db, supabase)}
+        store_parsed_result_digests(digests, db, PARSER_VERSION)
+        append_checkpoint(checkpoint_file, [
+            (path, 'failed', 'not synced to Supabase') if path in unsynced else (path, status, error)
+            for path, status, error in checkpoint_entries
+        ])
+        progress.advance(len(checkpoint_entries))
+        batch.clear()
+        digests.clear()
+        checkpoint_entries.clear()
+        key_paths.clear()
+
+    context = multiprocessing.get_context('spawn')
+    with open(checkpoint_path, 'a') as checkpoint_file, \
+            ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        paths = [path for path, _, _ in pending]
+        for path, digest, parsed, confident, error in executor.map(process_file, paths, chunksize=4):
+            if error:
+                logger.error(f"Failed to process {path}: {error}")
+                checkpoint_entries.append((path, 'failed', error))
+            else:
+                # Same digest for the same user means the same report, which keeps replays idempotent
+                user = users[user_for_path[path]]
+                import_key = f"{user['_id']}:{digest}"
+                batch.append((user, parsed, import_key, date_for_path[path]))
+                key_paths[import_key] = path
+                if confident:
+                    digests[digest] = parsed
+                checkpoint_entries.append((path, 'done', None))
+            if len(checkpoint_entries) >= batch_size:
+                flush()
+        if checkpoint_entries:
+            flush()
+    progress.advance(0, force=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--dir', help='Directory of report images, one subdirectory per user.')
+    source.add_argument('--manifest', help='CSV with path, email or registration_id, and optional date columns.')
+    parser.add_argument('--user', help='Email or registration id that owns every file in --dir.')
+    parser.add_argument('--checkpoint', help='Checkpoint file (default: <dir or manifest>.checkpoint).')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='OCR worker processes.')
+    parser.add_argument('--batch-size', type=int, default=50, help='Reports written per database batch.')
+    args = parser.parse_args(argv)
+
+    if args.manifest:
+        try:
+            files = list(files_from_manifest(args.manifest))
+        except ValueError as e:
+            parser.error(str(e))
+    else:
+        files = list(files_from_directory(args.dir, args.user))
+    checkpoint_path = args.checkpoint or f"{(args.manifest or args.dir).rstrip(os.sep)}.checkpoint"
+
+    run_import(files, checkpoint_path, args.workers, args.batch_size)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,9 @@
 import os
 import json
-from datetime import datetime
+from datetime import datetime, timezone
 from bson import ObjectId
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 from dotenv import load_dotenv
 from supabase import create_client, Client
 import logging
@@ -48,10 +49,15 @@ def get_user_by_id(user_id, mongo_db):
 
 
 def create_user(user_data, mongo_db):
-    """Insert new user data into MongoDB."""
+    """
+    Insert new user data into MongoDB.
+    Raises DuplicateKeyError when the email or registration ID is already taken.
+    """
     try:
         result = mongo_db.users.insert_one(user_data)
         return result.inserted_id
+    except DuplicateKeyError:
+        raise
     except Exception as e:
         logger.error(f"Error creating user in MongoDB: {e}")
         return None
@@ -83,13 +89,51 @@ def convert_mongo_to_supabase(data):
         return data
 
 
+# Report fields that older documents copied from the user record (report field -> user field)
+DENORMALIZED_USER_FIELDS = {
+    "registration_id": "registration_id",
+    "user_name": "name",
+    "user_email": "email",
+    "user_age": "age",
+    "user_gender": "gender"
+}
+
+REPORT_SCHEMA_VERSION = 2
+
+# Report fields that only exist in MongoDB and have no column in Supabase test_results
+MONGO_ONLY_REPORT_FIELDS = ("schema_version", "import_key", "pending_sync")
+
+
+def build_test_result_document(user_id, test_data, timestamp=None):
+    """
+    Build a compact report document.
+
+    Only the user id is stored; name, email, age, gender and registration id
+    are read from the user record.
+    """
+    return {
+        "user_id": str(user_id),
+        "test_data": test_data.get("tests", {}),  # Extract tests from the parsed data
+        "timestamp": timestamp or datetime.now(),
+        "source": test_data.get("source", "image"),  # default source
+        "schema_version": REPORT_SCHEMA_VERSION
+    }
+
+
+def build_supabase_report_row(document):
+    """Convert a report document to a Supabase test_results row without the MongoDB-only fields."""
+    row = convert_mongo_to_supabase(document)
+    for field in MONGO_ONLY_REPORT_FIELDS:
+        row.pop(field, None)
+    return row
+
+
 def store_test_result(user_id, test_data, mongo_db, supabase):
     """
     Store test results in both MongoDB and Supabase.
 
-    The test document combines:
-      • The parsed test data (from OCR or voice)
-      • The registered user details from the user record
+    The user is looked up to resolve the Supabase foreign key, but the stored
+    document only references the user by id.
     """
     try:
         # Get user details from MongoDB
@@ -98,25 +142,20 @@ def store_test_result(user_id, test_data, mongo_db, supabase):
             logger.error(f"User not found with ID: {user_id}")
             return None, None
 
-        # Prepare the test result document using the registered user details
-        test_result = {
-            "user_id": str(user_id),
-            "registration_id": user.get("registration_id"),
-            "user_name": user.get("name"),
-            "user_email": user.get("email"),
-            "user_age": str(user.get("age")),
-            "user_gender": user.get("gender"),
-            "test_data": test_data.get("tests", {}),  # Extract tests from the parsed data
-            "timestamp": datetime.now(),
-            "source": test_data.get("source", "image")  # default source
-        }
+        # Prepare the test result document; user details are referenced by id only
+        test_result = build_test_result_document(user_id, test_data)
 
         # Insert into MongoDB: use "reports" collection
         mongo_result = mongo_db.reports.insert_one(test_result)
         logger.info(f"Test result stored in MongoDB with ID: {mongo_result.inserted_id}")
 
+        # Keep the per-analyte time series in step with the new report
+        update_analyte_series(user_id, test_result["test_data"], test_result["timestamp"],
+                              mongo_result.inserted_id, mongo_db)
+        bump_report_version(user_id, mongo_db)
+
         # Prepare the data for Supabase
-        supabase_data = convert_mongo_to_supabase(test_result)
+        supabase_data = build_supabase_report_row(test_result)
 
         # Get the Supabase user ID for the foreign key constraint
         supabase_user = supabase.table("users").select("id").eq("registration_id",
@@ -138,6 +177,67 @@ def store_test_result(user_id, test_data, mongo_db, supabase):
         return None, None
 
 
+def build_report_version_update():
+    """Update that marks a user's report history as changed (see bump_report_version)."""
+    return {
+        "$inc": {"report_version": 1},
+        "$set": {"reports_updated_at": datetime.now(timezone.utc)}
+    }
+
+
+def bump_report_version(user_id, mongo_db):
+    """
+    Increment the user's report_version stamp. The profile page derives its
+    ETag and Last-Modified from it, so it must change whenever a report is added.
+    """
+    try:
+        if isinstance(user_id, str):
+            user_id = ObjectId(user_id)
+        mongo_db.users.update_one({"_id": user_id}, build_report_version_update())
+    except Exception as e:
+        logger.error(f"Error updating report version: {e}")
+
+
+def get_user_report_ids(user_id, mongo_db):
+    """Retrieve only the ids of a user's reports, newest first."""
+    try:
+        cursor = mongo_db.reports.find({"user_id": str(user_id)}, {"_id": 1}).sort("timestamp", -1)
+        return [doc["_id"] for doc in cursor]
+    except Exception as e:
+        logger.error(f"Error retrieving report ids: {e}")
+        return []
+
+
+def get_reports_by_ids(report_ids, mongo_db):
+    """Retrieve the given reports in one query."""
+    if not report_ids:
+        return []
+    try:
+        return list(mongo_db.reports.find({"_id": {"$in": list(report_ids)}}))
+    except Exception as e:
+        logger.error(f"Error retrieving reports: {e}")
+        return []
+
+
+def iter_user_test_results(user_id, mongo_db, since=None, batch_size=200):
+    """
+    Iterate a user's reports oldest first through a server-side cursor.
+    Only the exported fields are fetched; since limits the results to reports after that time.
+    """
+    query = {"user_id": str(user_id)}
+    if since:
+        query["timestamp"] = {"$gt": since}
+    cursor = mongo_db.reports.find(
+        query,
+        {"test_data": 1, "timestamp": 1, "source": 1}
+    ).sort("timestamp", 1).batch_size(batch_size)
+    try:
+        for report in cursor:
+            yield report
+    finally:
+        cursor.close()
+
+
 def get_user_test_results(user_id, mongo_db):
     """Retrieve all test results for a given user (from the 'reports' collection)."""
     try:
@@ -146,3 +246,253 @@ def get_user_test_results(user_id, mongo_db):
     except Exception as e:
         logger.error(f"Error retrieving test results: {e}")
         return []
+
+
+def parse_numeric_value(value):
+    """
+    Convert a stored test value such as "14.5", "5,100" or "<0.5" to a float.
+    Returns None for values that are not numeric.
+    """
+    if value is None:
+        return None
+    cleaned = str(value).strip().lstrip("<>").replace(",", "")
+    try:
+        return float(cleaned)
+    except ValueError:
+        return None
+
+
+def normalize_analyte_name(name):
+    """Normalize a test name so that "Hemoglobin" and "HEMOGLOBIN " share one series."""
+    return " ".join(str(name).split()).lower()
+
+
+def build_analyte_series_updates(user_id, tests, timestamp, report_id, historical=False):
+    """
+    Build the upserts that fold one report into the user's analyte series.
+
+    Each (user, analyte) pair is a single document in the "analyte_series"
+    collection holding the ordered points plus running min/max/last/count,
+    so a trend can be served without scanning the reports.
+
+    With historical=True the point is inserted in timestamp order instead of
+    appended, and last/last_timestamp are left alone; call
+    refresh_analyte_series_last afterwards.
+    """
+    updates = []
+    for name, raw_value in tests.items():
+        value = parse_numeric_value(raw_value)
+        if value is None:
+            continue
+        analyte = normalize_analyte_name(name)
+        if not analyte:
+            continue
+        point = {
+            "timestamp": timestamp,
+            "value": value,
+            "raw_value": raw_value,
+            "report_id": report_id
+        }
+        if historical:
+            push = {"points": {"$each": [point], "$sort": {"timestamp": 1}}}
+            fields = {"name": name}
+        else:
+            push = {"points": point}
+            fields = {"name": name, "last": value, "last_timestamp": timestamp}
+        updates.append(UpdateOne(
+            {"user_id": str(user_id), "analyte": analyte},
+            {
+                "$push": push,
+                "$inc": {"count": 1},
+                "$min": {"min": value},
+                "$max": {"max": value},
+                "$set": fields
+            },
+            upsert=True
+        ))
+    return updates
+
+
+def refresh_analyte_series_last(user_ids, mongo_db):
+    """Set last/last_timestamp of the users' series from their newest point."""
+    mongo_db.analyte_series.update_many(
+        {"user_id": {"$in": [str(user_id) for user_id in user_ids]}},
+        [{"$set": {
+            "last": {"$arrayElemAt": ["$points.value", -1]},
+            "last_timestamp": {"$arrayElemAt": ["$points.timestamp", -1]}
+        }}]
+    )
+
+
+def update_analyte_series(user_id, tests, timestamp, report_id, mongo_db):
+    """Apply a report's values to the per-user analyte series in one bulk write."""
+    updates = build_analyte_series_updates(user_id, tests, timestamp, report_id)
+    if not updates:
+        return 0
+    try:
+        result = mongo_db.analyte_series.bulk_write(updates, ordered=False)
+        return result.upserted_count + result.modified_count
+    except Exception as e:
+        logger.error(f"Error updating analyte series: {e}")
+        return 0
+
+
+def get_user_trends(user_id, mongo_db):
+    """Retrieve the running summary (without points) of every analyte tracked for a user."""
+    try:
+        return list(mongo_db.analyte_series.find(
+            {"user_id": str(user_id)},
+            {"_id": 0, "points": 0}
+        ).sort("analyte", 1))
+    except Exception as e:
+        logger.error(f"Error retrieving trends: {e}")
+        return []
+
+
+def get_user_analyte_series(user_id, analyte, mongo_db):
+    """Retrieve the full time series of one analyte for a user."""
+    try:
+        return mongo_db.analyte_series.find_one(
+            {"user_id": str(user_id), "analyte": normalize_analyte_name(analyte)},
+            {"_id": 0}
+        )
+    except Exception as e:
+        logger.error(f"Error retrieving analyte series: {e}")
+        return None
+
+
+def get_parsed_result_by_digest(digest, mongo_db, parser_version):
+    """
+    Return the parsed result previously produced for an upload with this SHA-256
+    digest, or None when there is none from this parser version.
+    """
+    try:
+        entry = mongo_db.report_digests.find_one({"_id": digest, "parser_version": parser_version})
+        return entry["parsed"] if entry else None
+    except Exception as e:
+        logger.error(f"Error retrieving parsed result by digest: {e}")
+        return None
+
+
+def build_parsed_result_digest_update(digest, parsed, parser_version, now):
+    """
+    Filter and update that store a parsed result under its digest, replacing an
+    entry from another parser version. When an entry from the same version
+    exists the upsert fails with a duplicate key, so the first result wins.
+    """
+    return (
+        {"_id": digest, "parser_version": {"$ne": parser_version}},
+        {"$set": {"parsed": parsed, "parser_version": parser_version, "created_at": now}}
+    )
+
+
+def store_parsed_result_digest(digest, parsed, mongo_db, parser_version):
+    """Remember the parsed result of an upload under its SHA-256 digest."""
+    try:
+        mongo_db.report_digests.update_one(
+            *build_parsed_result_digest_update(digest, parsed, parser_version, datetime.now()), upsert=True)
+    except DuplicateKeyError:
+        pass
+    except Exception as e:
+        logger.error(f"Error storing parsed result digest: {e}")
+
+
+# Writes an imported report still owes after its MongoDB insert, in order
+IMPORT_SYNC_STAGES = ["series", "supabase"]
+
+
+def store_test_results_batch(entries, mongo_db, supabase):
+    """
+    Store many parsed reports at once, as the bulk importer does.
+
+    entries is a list of (user, test_data, import_key, timestamp) tuples,
+    where user is the user document, import_key identifies the source file
+    and timestamp is the date of the report (None for now). Reports are
+    upserted by import_key, so replaying a batch after an interruption does
+    not create duplicates.
+
+    A new report lists the writes it still owes in pending_sync: "series"
+    (analyte series and report version) and "supabase" (the Supabase row).
+    Each stage is removed once its write succeeded, and every replay
+    finishes the stages left over by an interrupted run. Returns the
+    import keys of the reports that are still pending.
+    """
+    if not entries:
+        return []
+    users = {}
+    operations = []
+    for user, test_data, import_key, timestamp in entries:
+        document = build_test_result_document(user["_id"], test_data, timestamp)
+        document["import_key"] = import_key
+        document["pending_sync"] = list(IMPORT_SYNC_STAGES)
+        users[import_key] = user
+        operations.append(UpdateOne({"import_key": import_key}, {"$setOnInsert": document}, upsert=True))
+    mongo_db.reports.bulk_write(operations, ordered=True)
+
+    # New reports plus any that an earlier run inserted but did not finish
+    pending = list(mongo_db.reports.find(
+        {"import_key": {"$in": list(users)}, "pending_sync.0": {"$exists": True}}
+    ).sort("timestamp", 1))
+    if not pending:
+        return []
+
+    series_pending = [doc for doc in pending if "series" in doc["pending_sync"]]
+    if series_pending:
+        series_updates = []
+        for doc in series_pending:
+            series_updates.extend(build_analyte_series_updates(
+                doc["user_id"], doc["test_data"], doc["timestamp"], doc["_id"], historical=True))
+        user_ids = {users[doc["import_key"]]["_id"] for doc in series_pending}
+        if series_updates:
+            mongo_db.analyte_series.bulk_write(series_updates, ordered=True)
+            refresh_analyte_series_last(user_ids, mongo_db)
+        mongo_db.users.bulk_write(
+            [UpdateOne({"_id": user_id}, build_report_version_update()) for user_id in user_ids],
+            ordered=False
+        )
+        mongo_db.reports.update_many({"_id": {"$in": [doc["_id"] for doc in series_pending]}},
+                                     {"$pull": {"pending_sync": "series"}})
+
+    unsynced = []
+    supabase_pending = [doc for doc in pending if "supabase" in doc["pending_sync"]]
+    if supabase_pending:
+        registration_ids = list({users[doc["import_key"]].get("registration_id") for doc in supabase_pending})
+        supabase_users = supabase.table("users").select("id, registration_id").in_(
+            "registration_id", registration_ids).execute()
+        supabase_ids = {row["registration_id"]: row["id"] for row in supabase_users.data}
+        rows, synced = [], []
+        for doc in supabase_pending:
+            registration_id = users[doc["import_key"]].get("registration_id")
+            supabase_user_id = supabase_ids.get(registration_id)
+            if supabase_user_id is None:
+                # Left pending, so a replay after the user is synced writes the row
+                logger.error(f"User not found in Supabase with registration_id: {registration_id}")
+                unsynced.append(doc["import_key"])
+                continue
+            row = build_supabase_report_row(doc)
+            row["user_id"] = supabase_user_id
+            rows.append(row)
+            synced.append(doc["_id"])
+        if rows:
+            supabase.table("test_results").insert(rows).execute()
+            mongo_db.reports.update_many({"_id": {"$in": synced}}, {"$pull": {"pending_sync": "supabase"}})
+
+    logger.info(f"Completed {len(pending) - len(unsynced)} imported reports")
+    return unsynced
+
+
+def store_parsed_result_digests(results, mongo_db, parser_version):
+    """Batch form of store_parsed_result_digest for a {digest: parsed} mapping."""
+    if not results:
+        return
+    try:
+        now = datetime.now()
+        mongo_db.report_digests.bulk_write([
+            UpdateOne(*build_parsed_result_digest_update(digest, parsed, parser_version, now), upsert=True)
+            for digest, parsed in results.items()
+        ], ordered=False)
+    except BulkWriteError as e:
+        if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+            logger.error(f"Error storing parsed result digests: {e}")
+    except Exception as e:
+        logger.error(f"Error storing parsed result digests: {e}")
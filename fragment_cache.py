@@ -0,0 +1,30 @@
+import threading
+from collections import OrderedDict
+
+
+class FragmentCache:
+    """
+    Thread-safe LRU cache of rendered HTML fragments.
+
+    Used for content that never changes once written (such as a report's
+    result card), so entries are only ever evicted, never invalidated.
+    """
+
+    def __init__(self, max_entries=5000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
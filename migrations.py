@@ -0,0 +1,119 @@
+import logging
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from database import build_analyte_series_updates, DENORMALIZED_USER_FIELDS, REPORT_SCHEMA_VERSION
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def backfill_analyte_series(mongo_db, user_id=None, batch_size=500):
+    """
+    Rebuild the "analyte_series" collection from the existing reports.
+
+    Reports are replayed oldest first so that the points and the "last" value
+    come out in the same order the write path would have produced them.
+    Pass a user_id to rebuild only that user's series.
+    """
+    query = {"user_id": str(user_id)} if user_id else {}
+    mongo_db.analyte_series.delete_many(query)
+
+    cursor = mongo_db.reports.find(
+        query,
+        {"user_id": 1, "test_data": 1, "timestamp": 1}
+    ).sort("timestamp", 1).batch_size(batch_size)
+
+    pending = []
+    reports_processed = 0
+    for report in cursor:
+        pending.extend(build_analyte_series_updates(
+            report["user_id"], report.get("test_data", {}), report.get("timestamp"), report["_id"]
+        ))
+        reports_processed += 1
+        if len(pending) >= batch_size:
+            # Ordered so that repeated updates to one series keep their order
+            mongo_db.analyte_series.bulk_write(pending, ordered=True)
+            pending = []
+    if pending:
+        mongo_db.analyte_series.bulk_write(pending, ordered=True)
+
+    logger.info(f"Backfilled analyte series from {reports_processed} reports")
+    return reports_processed
+
+
+def collection_storage_stats(mongo_db, collection_name):
+    """Return document count, data size, storage size and index size of a collection."""
+    stats = mongo_db.command("collStats", collection_name)
+    return {
+        "count": stats.get("count", 0),
+        "size": stats.get("size", 0),
+        "avg_obj_size": stats.get("avgObjSize", 0),
+        "storage_size": stats.get("storageSize", 0),
+        "total_index_size": stats.get("totalIndexSize", 0)
+    }
+
+
+def history_read_bytes(mongo_db, sample_users=20):
+    """
+    Measure the bytes a profile history read transfers, averaged over a sample of users.
+    Documents are fetched as raw BSON so the figure is the size on the wire.
+    """
+    reports = mongo_db.reports.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+    user_ids = mongo_db.reports.distinct("user_id")[:sample_users]
+    if not user_ids:
+        return 0
+    total = 0
+    for user_id in user_ids:
+        total += sum(len(doc.raw) for doc in reports.find({"user_id": user_id}))
+    return total // len(user_ids)
+
+
+def migrate_reports_to_compact(mongo_db, supabase=None, batch_size=1000):
+    """
+    Strip the user fields copied into older reports so they match the compact schema.
+
+    Both stores are walked once in id order: each batch selects the next
+    legacy ids after the last one seen and rewrites them with a single
+    update, so already migrated rows are never scanned again.
+    """
+    unset = {field: "" for field in DENORMALIZED_USER_FIELDS}
+    legacy_query = {"schema_version": {"$ne": REPORT_SCHEMA_VERSION}}
+
+    migrated = 0
+    last_id = None
+    while True:
+        query = dict(legacy_query, _id={"$gt": last_id}) if last_id is not None else legacy_query
+        ids = [doc["_id"] for doc in mongo_db.reports.find(query, {"_id": 1}).sort("_id", 1).limit(batch_size)]
+        if not ids:
+            break
+        last_id = ids[-1]
+        result = mongo_db.reports.update_many(
+            {"_id": {"$in": ids}},
+            {"$unset": unset, "$set": {"schema_version": REPORT_SCHEMA_VERSION}}
+        )
+        migrated += result.modified_count
+        logger.info(f"Compacted {migrated} reports so far")
+
+    cleared = 0
+    if supabase is not None:
+        cleared_values = {field: None for field in DENORMALIZED_USER_FIELDS}
+        last_id = None
+        while True:
+            select = supabase.table("test_results").select("id").not_.is_("user_email", "null")
+            if last_id is not None:
+                select = select.gt("id", last_id)
+            rows = select.order("id").limit(batch_size).execute()
+            ids = [row["id"] for row in rows.data]
+            if not ids:
+                break
+            last_id = ids[-1]
+            updated = supabase.table("test_results").update(cleared_values).in_("id", ids).execute()
+            if not updated.data:
+                # Nothing was changed, for example blocked by row level security
+                logger.error(f"No Supabase rows cleared out of a batch of {len(ids)}, stopping")
+                break
+            cleared += len(updated.data)
+            logger.info(f"Cleared user fields on {cleared} Supabase rows so far")
+
+    return migrated, cleared
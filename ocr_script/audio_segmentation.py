@@ -0,0 +1,100 @@
+import sys
+import math
+from array import array
+
+
+class SilenceSegmenter:
+    """
+    Energy-based voice activity detection that cuts 16-bit mono PCM into segments at pauses.
+
+    Audio is fed in arbitrary chunks; feed() returns every segment that became
+    complete. A segment ends after min_silence_ms of silence following speech,
+    or is cut at its quietest frame once it reaches max_segment_s so that no
+    single recognition request grows unbounded. Segments without any speech
+    are dropped.
+    """
+
+    def __init__(self, sample_rate, energy_threshold=300, frame_ms=30, min_silence_ms=500,
+                 min_segment_s=1.0, max_segment_s=30.0):
+        self.sample_rate = sample_rate
+        self.energy_threshold = energy_threshold
+        self.frame_bytes = int(sample_rate * frame_ms / 1000) * 2
+        self.min_silence_frames = max(1, min_silence_ms // frame_ms)
+        self.min_segment_frames = int(min_segment_s * 1000 / frame_ms)
+        self.max_segment_frames = int(max_segment_s * 1000 / frame_ms)
+
+        self._pending = b""
+        self._frames = []  # (pcm, rms) of the current segment
+        self._silent_frames = 0
+        self._voiced = False
+
+    def feed(self, pcm):
+        """Add PCM bytes; returns the list of segments (bytes) completed by them."""
+        segments = []
+        data = self._pending + pcm
+        usable = len(data) - len(data) % self.frame_bytes
+        self._pending = data[usable:]
+        for offset in range(0, usable, self.frame_bytes):
+            segment = self._add_frame(data[offset:offset + self.frame_bytes])
+            if segment:
+                segments.append(segment)
+        return segments
+
+    def flush(self):
+        """Returns the trailing segment, if it contains speech."""
+        if self._pending:
+            self._frames.append((self._pending, 0.0))
+            self._pending = b""
+        segment = self._emit(len(self._frames))
+        return [segment] if segment else []
+
+    def _add_frame(self, frame):
+        rms = frame_rms(frame)
+        self._frames.append((frame, rms))
+        if rms >= self.energy_threshold:
+            self._voiced = True
+            self._silent_frames = 0
+        else:
+            self._silent_frames += 1
+
+        if not self._voiced and self._silent_frames > self.min_silence_frames:
+            # Keep only a short lead-in of silence before speech starts
+            self._frames.pop(0)
+            return None
+        if (self._voiced and self._silent_frames >= self.min_silence_frames
+                and len(self._frames) >= self.min_segment_frames):
+            return self._emit(len(self._frames))
+        if len(self._frames) >= self.max_segment_frames:
+            return self._emit(self._quietest_cut())
+        return None
+
+    def _quietest_cut(self):
+        """Index just after the quietest frame in the second half of the segment."""
+        half = len(self._frames) // 2
+        quietest = min(range(half, len(self._frames)), key=lambda i: self._frames[i][1])
+        return quietest + 1
+
+    def _emit(self, cut):
+        head, self._frames = self._frames[:cut], self._frames[cut:]
+        voiced = any(rms >= self.energy_threshold for _, rms in head)
+        self._voiced = any(rms >= self.energy_threshold for _, rms in self._frames)
+        self._silent_frames = 0
+        if not voiced:
+            return None
+        return b"".join(pcm for pcm, _ in head)
+
+
+def frame_rms(frame):
+    """Root mean square of a frame of little-endian 16-bit samples."""
+    samples = array("h", frame[:len(frame) - len(frame) % 2])
+    if sys.byteorder == "big":
+        samples.byteswap()
+    if not samples:
+        return 0.0
+    return math.sqrt(sum(s * s for s in samples) / len(samples))
+
+
+def split_on_silence(pcm, sample_rate, **kwargs):
+    """Splits a complete 16-bit mono PCM buffer into speech segments."""
+    segmenter = SilenceSegmenter(sample_rate, **kwargs)
+    return segmenter.feed(pcm) + segmenter.flush()
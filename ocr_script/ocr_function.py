@@ -1,18 +1,140 @@
 import re
-from PIL import Image
+import time
+import logging
+import threading
+from collections import Counter
+from PIL import Image, ImageOps
 import pytesseract
 import os
+from ocr_script import regex_engine as regex
+
+logger = logging.getLogger(__name__)
 
 # Configure pytesseract with the correct path
 pytesseract.pytesseract.tesseract_cmd = "E:\\Aditya\\tesseract.exe"
 
+# Images with more pixels than this are rejected before their bitmap is decoded
+MAX_IMAGE_PIXELS = int(os.getenv("OCR_MAX_IMAGE_PIXELS", 40_000_000))
+# Longest side OCR needs (about 240 DPI for an A4 page); larger photos are decoded at a reduced scale
+OCR_TARGET_DIMENSION = int(os.getenv("OCR_TARGET_DIMENSION", 2000))
+
+# Let PIL's own decompression bomb guard use the same budget
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+
+# Directory with the tessdata_fast models used by the first OCR pass (falls back to the default models)
+TESSDATA_FAST_DIR = os.getenv("TESSDATA_FAST_DIR")
+# Score at which an OCR pass is accepted without trying the costlier ones
+OCR_QUALITY_THRESHOLD = float(os.getenv("OCR_QUALITY_THRESHOLD", 0.7))
+# Number of parsed tests that counts as a complete report when scoring
+OCR_EXPECTED_TESTS = 5
+# Log the tier hit rates every this many documents
+OCR_STATS_LOG_INTERVAL = 100
+
+# Lines that start the test section of a report
+HEADER_PATTERNS = [
+    r"COMPLETE\s+BLOOD\s+COUNT", r"\bCBC\b", r"\bTEST\b", r"\bINVESTIGATION\b"
+]
+
+# OCR passes from cheapest to costliest; the first one scoring above the threshold wins.
+#   fast    - fast LSTM models, --psm 6 keeps table rows together, no orientation detection
+#   default - the standard models with automatic page segmentation
+#   osd     - detect and correct page orientation first
+#   enhance - grayscale, autocontrast and 2x upscaling of small images, single column segmentation
+OCR_TIERS = [
+    {"name": "fast", "config": "--oem 1 --psm 6", "fast_models": True},
+    {"name": "default", "config": "--oem 1 --psm 3"},
+    {"name": "osd", "config": "--oem 1 --psm 6", "detect_orientation": True},
+    {"name": "enhance", "config": "--oem 1 --psm 4", "enhance": True},
+]
+
+# Version of the OCR tiers and parser output; bump it when either changes so
+# parsed results cached by upload digest are no longer reused
+PARSER_VERSION = 3
+
+# Wall-clock budget for parsing one document, in seconds
+OCR_PARSE_TIME_BUDGET = float(os.getenv("OCR_PARSE_TIME_BUDGET", 2.0))
+# Longer OCR output is truncated before parsing
+OCR_MAX_TEXT_CHARS = int(os.getenv("OCR_MAX_TEXT_CHARS", 100_000))
+
+_tier_hits = Counter()
+_tier_lock = threading.Lock()
+
+
+class ImageTooLargeError(ValueError):
+    """Raised when an image exceeds the configured pixel budget."""
+
+
+class ParseTimeoutError(Exception):
+    """Raised when parsing a document takes longer than its time budget."""
+
+
+class Deadline:
+    """Time budget of one parse; check() raises ParseTimeoutError once it is spent. 0 disables it."""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds if seconds else None
+
+    def check(self, stage):
+        if self.expires is not None and time.monotonic() > self.expires:
+            raise ParseTimeoutError(f"Parsing exceeded its {self.seconds} s budget during {stage}")
+
+
+def load_image_for_ocr(image_path):
+    """
+    Opens an image at no more resolution than OCR needs.
+
+    Only the header is read to check the pixel budget and pick a scale. JPEGs
+    are then decoded by the codec at 1/2, 1/4 or 1/8 scale via draft(); other
+    formats are shrunk with reduce() right after decoding.
+    """
+    try:
+        image = Image.open(image_path)
+    except Image.DecompressionBombError as e:
+        raise ImageTooLargeError(str(e))
+
+    width, height = image.size
+    if width * height > MAX_IMAGE_PIXELS:
+        image.close()
+        raise ImageTooLargeError(
+            f"Image is {width}x{height} ({width * height} pixels), over the limit of {MAX_IMAGE_PIXELS} pixels")
+
+    longest_side = max(width, height)
+    if longest_side >= 2 * OCR_TARGET_DIMENSION:
+        if image.format == "JPEG":
+            # draft() picks the smallest scale that is still at least the requested size
+            scale = longest_side / OCR_TARGET_DIMENSION
+            image.draft("RGB", (int(width / scale), int(height / scale)))
+        factor = max(image.size) // OCR_TARGET_DIMENSION
+        if factor >= 2:
+            image = reduce_image(image, factor)
+    return image
+
+
+def reduce_image(image, factor):
+    """
+    reduce() for every mode. Bilevel and palette images (common for scans) are
+    averaged in grayscale or RGB, 16-bit grayscale in 32-bit and converted back.
+    """
+    if image.mode == "1":
+        image = image.convert("L")
+    elif image.mode in ("P", "PA"):
+        image = image.convert("RGBA" if image.mode == "PA" or "transparency" in image.info else "RGB")
+    elif image.mode.startswith("I;16"):
+        return image.convert("I").reduce(factor).convert("I;16")
+    return image.reduce(factor)
+
 
 def extract_text_from_image(image_path):
     """
     Opens an image and extracts text using pytesseract OCR.
+    Raises ImageTooLargeError for images over the pixel budget.
     """
     try:
-        image = Image.open(image_path)
+        image = load_image_for_ocr(image_path)
+    except ImageTooLargeError:
+        raise
     except Exception as e:
         print(f"Error opening image {image_path}: {e}")
         return ""
@@ -20,6 +142,129 @@ def extract_text_from_image(image_path):
     return text
 
 
+def prepare_tier_image(image, tier):
+    """Apply the preprocessing a tier asks for; returns None if the tier does not apply."""
+    if tier.get("detect_orientation"):
+        try:
+            osd = pytesseract.image_to_osd(image, output_type=pytesseract.Output.DICT)
+        except pytesseract.TesseractError as e:
+            logger.info(f"Orientation detection failed: {e}")
+            return None
+        if not osd.get("rotate"):
+            # Already upright, the earlier passes saw the same image
+            return None
+        # Tesseract reports the clockwise correction, PIL rotates counter-clockwise
+        return image.rotate(-osd["rotate"], expand=True)
+    if tier.get("enhance"):
+        image = ImageOps.autocontrast(ImageOps.grayscale(image))
+        if max(image.size) < OCR_TARGET_DIMENSION:
+            image = image.resize((image.width * 2, image.height * 2), Image.LANCZOS)
+        return image
+    return image
+
+
+def tier_config(tier):
+    if tier.get("fast_models") and TESSDATA_FAST_DIR:
+        return f'--tessdata-dir "{TESSDATA_FAST_DIR}" {tier["config"]}'
+    return tier["config"]
+
+
+def score_parsed_report(text, parsed):
+    """
+    Scores an OCR pass between 0 and 1 from what parse_lab_report made of it:
+    how many tests were found, whether a test section header was seen and how
+    many of the values look like plausible lab numbers.
+    """
+    tests = parsed.get("tests", {})
+    test_score = min(len(tests) / OCR_EXPECTED_TESTS, 1.0)
+    header_score = 1.0 if any(re.search(pat, text, re.IGNORECASE) for pat in HEADER_PATTERNS) else 0.0
+    plausible = 0
+    for name, value in tests.items():
+        try:
+            number = float(str(value).lstrip("<>"))
+        except ValueError:
+            continue
+        if re.search(r"[A-Za-z]{2}", name) and 0 <= number < 1_000_000:
+            plausible += 1
+    plausible_score = plausible / len(tests) if tests else 0.0
+    return 0.5 * test_score + 0.2 * header_score + 0.3 * plausible_score
+
+
+def run_tiered_ocr(image_path):
+    """
+    Runs the OCR passes in OCR_TIERS until one scores above OCR_QUALITY_THRESHOLD.
+    Returns (text, parsed_report, tier_name) of the accepted or best-scoring pass.
+    Has no side effects, so it can run in a worker process.
+    """
+    image = load_image_for_ocr(image_path)
+    best = None
+    timeout = None
+    for tier in OCR_TIERS:
+        tier_image = prepare_tier_image(image, tier)
+        if tier_image is None:
+            continue
+        text = pytesseract.image_to_string(tier_image, config=tier_config(tier))
+        try:
+            parsed = parse_lab_report(text)
+        except ParseTimeoutError as e:
+            logger.warning(f"OCR tier '{tier['name']}' output could not be parsed in time: {e}")
+            timeout = e
+            continue
+        score = score_parsed_report(text, parsed)
+        logger.info(f"OCR tier '{tier['name']}' scored {score:.2f} for {image_path}")
+        if best is None or score > best[0]:
+            best = (score, text, parsed, tier["name"])
+        if score >= OCR_QUALITY_THRESHOLD:
+            break
+    if best is None:
+        raise timeout
+    _, text, parsed, tier_name = best
+    return text, parsed, tier_name
+
+
+def record_ocr_tier(tier_name):
+    """Counts which tier produced a document's result and periodically logs the hit rates."""
+    with _tier_lock:
+        _tier_hits[tier_name] += 1
+        total = sum(_tier_hits.values())
+    if total % OCR_STATS_LOG_INTERVAL == 0:
+        stats = get_ocr_tier_stats()
+        rates = ", ".join(f"{name}: {stats['tiers'][name]['rate']:.1%}" for name in stats["tiers"])
+        logger.info(f"OCR tier hit rates over {total} documents: {rates}")
+
+
+def get_ocr_tier_stats():
+    """Per-tier hit counts and rates since the process started."""
+    with _tier_lock:
+        hits = dict(_tier_hits)
+    total = sum(hits.values())
+    return {
+        "total": total,
+        "tiers": {
+            tier["name"]: {
+                "hits": hits.get(tier["name"], 0),
+                "rate": hits.get(tier["name"], 0) / total if total else 0.0
+            }
+            for tier in OCR_TIERS
+        }
+    }
+
+
+def is_confident_result(text, parsed):
+    """Whether a parsed report is good enough to be reused for identical uploads."""
+    return bool(parsed.get("tests")) and score_parsed_report(text, parsed) >= OCR_QUALITY_THRESHOLD
+
+
+def extract_and_parse_report(image_path):
+    """
+    Extracts and parses a report with the tiered OCR strategy, recording which tier was used.
+    Returns (text, parsed_report).
+    """
+    text, parsed, tier_name = run_tiered_ocr(image_path)
+    record_ocr_tier(tier_name)
+    return text, parsed
+
+
 def extract_test_result_from_line(line):
     """
     Tokenizes a candidate test line and returns a tuple (test_name, test_value)
@@ -53,21 +298,21 @@ def extract_age_sex(text):
     """
     age, sex = None, None
     # Pattern 1: "SEX/ AGE: MALE /23"
-    m = re.search(r"SEX\s*/\s*AGE\s*(?:[:=])?\s*(Male|Female)\s*/\s*(\d+)",
-                  text, re.IGNORECASE)
+    m = regex.search(r"SEX\s*/\s*AGE\s*(?:[:=])?\s*(Male|Female)\s*/\s*(\d+)",
+                     text, re.IGNORECASE)
     if m:
         sex = m.group(1).strip().title()
         age = m.group(2).strip()
         return age, sex
     # Pattern 2: "Age/Sex :27YRS/M" or "Age/Gender :20/Male"
-    m = re.search(r"Age(?:/Gender|/Sex)\s*(?:[:=])?\s*([^\n]+?)\s*/\s*([MF]|Male|Female)",
-                  text, re.IGNORECASE)
+    m = regex.search(r"Age(?:/Gender|/Sex)\s*(?:[:=])?\s*([^\n]{1,60}?)\s*/\s*([MF]|Male|Female)",
+                     text, re.IGNORECASE)
     if m:
         age_raw = m.group(1).strip()
-        if re.search(r"[A-Za-z]", age_raw):
+        if regex.search(r"[A-Za-z]", age_raw):
             age = age_raw
         else:
-            num = re.search(r"(\d+)", age_raw)
+            num = regex.search(r"(\d+)", age_raw)
             age = num.group(1) if num else age_raw
         grp = m.group(2).strip()
         if grp.upper() in {"M", "MALE"}:
@@ -75,9 +320,9 @@ def extract_age_sex(text):
         elif grp.upper() in {"F", "FEMALE"}:
             sex = "Female"
         return age, sex
-    # Pattern 3: Using positive lookahead e.g. "Age 2y10m26d Sex. Female"
-    m = re.search(r"Age\s*(?:[:=])?\s*(?P<age>[^\n]+?)(?=\s+Sex[.:]?\s+(?P<sex>Male|Female))",
-                  text, re.IGNORECASE)
+    # Pattern 3: e.g. "Age 2y10m26d Sex. Female"
+    m = regex.search(r"Age\s*(?:[:=])?\s*(?P<age>[^\n]{1,60}?)\s+Sex[.:]?\s+(?P<sex>Male|Female)",
+                     text, re.IGNORECASE)
     if m:
         age = m.group("age").strip()
         sex = m.group("sex").strip().title()
@@ -85,43 +330,64 @@ def extract_age_sex(text):
     # Fallback: Line-by-line scan.
     for line in text.splitlines():
         line = line.strip()
-        m_age = re.search(r"Age\s*(?:[:=])?\s*([^\n]+)", line, re.IGNORECASE)
-        m_sex = re.search(r"(Sex|Gender)\s*(?:[:=])?\s*(Male|Female)", line, re.IGNORECASE)
+        m_age = regex.search(r"Age\s*(?:[:=])?\s*([^\n]{1,120})", line, re.IGNORECASE)
+        m_sex = regex.search(r"(Sex|Gender)\s*(?:[:=])?\s*(Male|Female)", line, re.IGNORECASE)
         if m_age and m_sex:
             age_str = m_age.group(1).strip()
-            if re.search(r"[A-Za-z]", age_str):
+            if regex.search(r"[A-Za-z]", age_str):
                 age = age_str.split("\n")[0].strip()
             else:
-                num = re.search(r"(\d+)", age_str)
+                num = regex.search(r"(\d+)", age_str)
                 age = num.group(1) if num else age_str
             sex = m_sex.group(2).strip().title()
             return age, sex
     # Final fallback: Separate full-text lookup.
-    m = re.search(r"Age\s*(?:[:=])?\s*([\dA-Za-z\s\-]+)", text, re.IGNORECASE)
+    m = regex.search(r"Age\s*(?:[:=])?\s*([\dA-Za-z\s\-]{1,120})", text, re.IGNORECASE)
     if m:
         age_str = m.group(1).strip()
         if "\n" in age_str:
             age_str = age_str.split("\n")[0].strip()
-        if re.search(r"[A-Za-z]", age_str):
+        if regex.search(r"[A-Za-z]", age_str):
             age = age_str
         else:
-            num = re.search(r"(\d+)", age_str)
+            num = regex.search(r"(\d+)", age_str)
             age = num.group(1) if num else age_str
-    m = re.search(r"(Sex|Gender)\s*(?:[:=])?\s*(Male|Female)", text, re.IGNORECASE)
+    m = regex.search(r"(Sex|Gender)\s*(?:[:=])?\s*(Male|Female)", text, re.IGNORECASE)
     if m:
         sex = m.group(2).strip().title()
     return age, sex
 
 
-def parse_lab_report(text):
+def normalize_ocr_text(text):
+    """
+    Bounds what the parser's regular expressions can backtrack over: runs of
+    spaces and tabs become one space, spaces around line breaks are dropped,
+    at most one blank line is kept in a row and the text is capped at
+    OCR_MAX_TEXT_CHARS. Together with the bounded quantifiers in the patterns
+    this keeps parsing linear in the length of the text.
+    """
+    if len(text) > OCR_MAX_TEXT_CHARS:
+        logger.warning(f"Truncating OCR text of {len(text)} characters to {OCR_MAX_TEXT_CHARS}")
+        text = text[:OCR_MAX_TEXT_CHARS]
+    text = regex.sub(r"[ \t\f\v]+", " ", text)
+    text = regex.sub(r" ?\n ?", "\n", text)
+    text = regex.sub(r"\n{3,}", "\n\n", text)
+    return text
+
+
+def parse_lab_report(text, time_budget=None):
     """
     Parses the full lab report text to extract patient details (registration number, name,
     age, sex) and test results from the CBC section.
+    Raises ParseTimeoutError if parsing takes longer than time_budget seconds
+    (OCR_PARSE_TIME_BUDGET by default).
     """
+    deadline = Deadline(OCR_PARSE_TIME_BUDGET if time_budget is None else time_budget)
     data = {}
     # Preprocess text: Normalize smart quotes.
     text = text.replace("‘", " ").replace("’", " ")
     text = text.replace("“", "\"").replace("”", "\"")
+    text = normalize_ocr_text(text)
 
     # Registration Number Extraction
     reg_num = None
@@ -135,70 +401,72 @@ def parse_lab_report(text):
         r"Patient\s+Code\s*[:\-]?\s*(\S+)"
     ]
     for pat in reg_patterns:
-        m = re.search(pat, text, re.IGNORECASE)
+        m = regex.search(pat, text, re.IGNORECASE)
         if m:
             candidate = m.group(1).strip()
-            if (("Regd" in pat or re.search(r"Reg\.?\s*no\.?", pat, re.IGNORECASE))
+            if (("Regd" in pat or regex.search(r"Reg\.?\s*no\.?", pat, re.IGNORECASE))
                     and not candidate.isdigit()):
                 continue
             reg_num = candidate
             break
     data["registration_no"] = reg_num
+    deadline.check("registration number extraction")
 
     # Patient Name Extraction
     name = None
     # (1) Look for "PATIENT NAME : <NAME>" ending before "SEX" or "Age"
-    m = re.search(r"PATIENT\s+NAME\s*[:=-]+\s*(.*?)\s+(?:SEX|Age)",
-                  text, re.IGNORECASE | re.DOTALL)
+    m = regex.search(r"PATIENT\s+NAME\s*[:=-]+\s*(.{0,120}?)\s+(?:SEX|Age)",
+                     text, re.IGNORECASE | re.DOTALL)
     if m:
         name = m.group(1).strip()
-        name = re.split(r"\s+PUID\s+", name, flags=re.IGNORECASE)[0].strip()
+        name = regex.split(r"\s+PUID\s+", name, flags=re.IGNORECASE)[0].strip()
     # (2) Look for a line starting with "NAME:" that stops at "Patient ID"
     if not name:
-        m = re.search(r"NAME\s*:\s*([A-Za-z\s,]+)(?:\s+Patient\s+ID\b|$)",
-                      text, re.IGNORECASE)
+        m = regex.search(r"NAME\s*:\s*([A-Za-z\s,]{1,120})(?:\s+Patient\s+ID\b|$)",
+                         text, re.IGNORECASE)
         if m:
             name = m.group(1).strip()
     # (3) Look for a line ending with "Sample Collected By"
     if not name:
-        m = re.search(r"^(?P<name>[A-Za-z][A-Za-z\s,]+?)\s+Sample Collected By",
-                      text, re.IGNORECASE | re.MULTILINE)
+        m = regex.search(r"^(?P<name>[A-Za-z][A-Za-z\s,]{1,120}?)\s+Sample Collected By",
+                         text, re.IGNORECASE | re.MULTILINE)
         if m:
             name = m.group("name").strip()
     # (4) Look for "Name : <NAME> Patient ID" pattern
     if not name:
-        m = re.search(r"Name\s*[:\-]?\s*([\w\.\s,]+?)\s+Patient\s+ID",
-                      text, re.IGNORECASE)
+        m = regex.search(r"Name\s*[:\-]?\s*([\w\.\s,]{1,120}?)\s+Patient\s+ID",
+                         text, re.IGNORECASE)
         if m:
             name = m.group(1).strip()
     # (5) Generic fallback: use any "Name:" pattern.
     if not name:
-        m = re.search(r"Name\s*[:\-]?\s*([A-Za-z\.,\s]+)",
-                      text, re.IGNORECASE)
+        m = regex.search(r"Name\s*[:\-]?\s*([A-Za-z\.,\s]{1,120})",
+                         text, re.IGNORECASE)
         if m:
             candidate = m.group(1).strip()
-            name = re.split(r"\s+(Patient|Age)", candidate, flags=re.IGNORECASE)[0].strip()
+            name = regex.split(r"\s+(Patient|Age)", candidate, flags=re.IGNORECASE)[0].strip()
     # (6) Use the line immediately preceding an "Age" field.
     if not name:
         lines = text.splitlines()
         for i, line in enumerate(lines):
-            if re.search(r"Age\s*(?:[:=])", line, re.IGNORECASE) and i > 0:
+            if regex.search(r"Age\s*(?:[:=])", line, re.IGNORECASE) and i > 0:
                 candidate = lines[i - 1].strip()
-                candidate = re.sub(r"^Name\s+", "", candidate, flags=re.IGNORECASE).strip()
-                if candidate and not re.search(
+                candidate = regex.sub(r"^Name\s+", "", candidate, flags=re.IGNORECASE).strip()
+                if candidate and not regex.search(
                         r"(Registered on|Sample Collected|UHID|Investigation|Complete Blood Count)",
                         candidate, re.IGNORECASE):
                     name = candidate
                     break
     # (7) Last resort: Title-based fallback.
     if not name:
-        m = re.search(r"^(Mr\.|Mrs\.|Ms\.)\s+([A-Za-z\s,]+)",
-                      text, re.IGNORECASE | re.MULTILINE)
+        m = regex.search(r"^(Mr\.|Mrs\.|Ms\.)\s+([A-Za-z\s,]{1,120})",
+                         text, re.IGNORECASE | re.MULTILINE)
         if m:
             name = f"{m.group(1)} {m.group(2)}".strip()
     if name and "PUID" in name:
         name = name.split("PUID")[0].strip()
     data["name"] = name
+    deadline.check("name extraction")
 
     # Age and Sex Extraction
     age, sex = extract_age_sex(text)
@@ -206,17 +474,15 @@ def parse_lab_report(text):
         age = age.split("\n")[0].strip()
     data["age"] = age
     data["sex"] = sex
+    deadline.check("age and sex extraction")
 
     # Test Results Extraction
     tests = {}
     lines = text.splitlines()
-    header_candidates = [
-        r"COMPLETE\s+BLOOD\s+COUNT", r"\bCBC\b", r"\bTEST\b", r"\bINVESTIGATION\b"
-    ]
     start_index = None
     for i, line in enumerate(lines):
-        for pat in header_candidates:
-            if re.search(pat, line, re.IGNORECASE):
+        for pat in HEADER_PATTERNS:
+            if regex.search(pat, line, re.IGNORECASE):
                 start_index = i + 1
                 break
         if start_index is not None:
@@ -226,10 +492,12 @@ def parse_lab_report(text):
     end_index = None
     if start_index is not None:
         for i, line in enumerate(lines[start_index:], start=start_index):
-            if re.search(footer_pattern, line, re.IGNORECASE):
+            if regex.search(footer_pattern, line, re.IGNORECASE):
                 end_index = i
                 break
 
+    deadline.check("test section detection")
+
     if start_index is not None and end_index is not None and start_index < end_index:
         test_section_lines = lines[start_index:end_index]
     elif start_index is not None:
@@ -244,6 +512,7 @@ def parse_lab_report(text):
         "DR.", "INVESTIGATION", "CLINICAL", "NOTES", "RESULT", "Est",
     }
     for line in test_section_lines:
+        deadline.check("test extraction")
         if not line.strip():
             continue
         if any(kw in line.upper() for kw in exclude_keywords):
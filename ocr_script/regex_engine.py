@@ -0,0 +1,53 @@
+import os
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+# "re" (default) or "re2"; RE2 (google-re2) guarantees linear-time matching
+OCR_REGEX_ENGINE = os.getenv("OCR_REGEX_ENGINE", "re")
+
+# Flags are passed to RE2 as an inline group, which both engines understand
+_INLINE_FLAGS = ((re.IGNORECASE, "i"), (re.MULTILINE, "m"), (re.DOTALL, "s"))
+
+
+def load_engine(name):
+    """Returns the regex module to use, falling back to re when RE2 is not installed."""
+    if name == "re2":
+        try:
+            import re2
+            return re2
+        except ImportError:
+            logger.warning("OCR_REGEX_ENGINE=re2 but google-re2 is not installed, using re")
+    return re
+
+
+engine = load_engine(OCR_REGEX_ENGINE)
+
+
+def with_flags(pattern, flags):
+    if engine is re or not flags:
+        return pattern, flags
+    inline = "".join(letter for flag, letter in _INLINE_FLAGS if flags & flag)
+    return f"(?{inline}){pattern}", 0
+
+
+def search(pattern, text, flags=0):
+    pattern, flags = with_flags(pattern, flags)
+    if flags:
+        return engine.search(pattern, text, flags)
+    return engine.search(pattern, text)
+
+
+def split(pattern, text, flags=0):
+    pattern, flags = with_flags(pattern, flags)
+    if flags:
+        return engine.split(pattern, text, flags=flags)
+    return engine.split(pattern, text)
+
+
+def sub(pattern, repl, text, flags=0):
+    pattern, flags = with_flags(pattern, flags)
+    if flags:
+        return engine.sub(pattern, repl, text, flags=flags)
+    return engine.sub(pattern, repl, text)
@@ -7,16 +7,53 @@ from pathlib import Path
 import tempfile
 import subprocess
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from ocr_script.audio_segmentation import split_on_silence
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Concurrent recognition requests per process across all dictations
+VOICE_RECOGNITION_WORKERS = int(os.getenv('VOICE_RECOGNITION_WORKERS', 8))
+# Retries of a single segment after a recognition service error
+VOICE_SEGMENT_RETRIES = int(os.getenv('VOICE_SEGMENT_RETRIES', 2))
+# Upper bound of a segment sent to the recognizer, in seconds
+VOICE_MAX_SEGMENT_SECONDS = float(os.getenv('VOICE_MAX_SEGMENT_SECONDS', 30))
+
+
+def needs_conversion(audio_file_path):
+    """Whether the file has to be converted before SpeechRecognition can read it."""
+    return not audio_file_path.lower().endswith(('.wav', '.aiff', '.flac'))
+
+
+def ffmpeg_command(input_path, output_path):
+    """FFmpeg arguments for converting an audio file to WAV."""
+    return ['ffmpeg', '-i', input_path, '-y', output_path]
+
+
+def ffmpeg_stream_command(sample_rate):
+    """FFmpeg arguments for decoding a container stream on stdin to 16-bit mono PCM on stdout."""
+    return ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-i', 'pipe:0',
+            '-f', 's16le', '-acodec', 'pcm_s16le', '-ac', '1', '-ar', str(sample_rate), 'pipe:1']
+
+
+def cleanup_temp_files(temp_files):
+    for temp_file in temp_files:
+        if os.path.exists(temp_file):
+            try:
+                os.unlink(temp_file)
+                logger.info(f"Removed temporary file: {temp_file}")
+            except Exception as e:
+                logger.error(f"Error removing temporary file: {e}")
+
 
 class VoiceProcessor:
     def __init__(self):
         # Load model lazily when needed
         self.nlp = None
+        self.recognition_pool = ThreadPoolExecutor(max_workers=VOICE_RECOGNITION_WORKERS)
 
     def load_model(self):
         if self.nlp is None:
@@ -43,67 +80,110 @@ class VoiceProcessor:
 
         try:
             # Convert audio to WAV format using FFmpeg if it's not already in a compatible format
-            if not audio_file_path.lower().endswith(('.wav', '.aiff', '.flac')):
-                try:
-                    # Create temporary WAV file
-                    wav_file = tempfile.NamedTemporaryFile(delete=False, suffix='.wav')
-                    wav_file.close()
-                    temp_files.append(wav_file.name)
-
-                    # Use FFmpeg to convert (if available)
-                    try:
-                        logger.info(f"Converting {audio_file_path} to WAV format at {wav_file.name}")
-                        subprocess.run(
-                            ['ffmpeg', '-i', audio_file_path, '-y', wav_file.name],
-                            check=True,
-                            capture_output=True
-                        )
-                        audio_file_path = wav_file.name
-                        logger.info(f"Conversion successful")
-                    except (subprocess.SubprocessError, FileNotFoundError) as e:
-                        logger.error(f"FFmpeg conversion failed: {e}")
-                        # If conversion fails, try direct processing
-                        logger.info("Trying direct processing...")
-                except Exception as e:
-                    logger.error(f"Error creating temporary file: {e}")
-                    # Continue with original file
-
-            # Process the audio file
-            recognizer = sr.Recognizer()
-            try:
-                logger.info(f"Opening audio file: {audio_file_path}")
-                with sr.AudioFile(audio_file_path) as source:
-                    audio_data = recognizer.record(source)
-
-                try:
-                    logger.info("Recognizing speech with Google...")
-                    text = recognizer.recognize_google(audio_data, language="en-US")
-                    logger.info(f"Recognized text: {text}")
-
-                    # Extract medical measurements and add source information
-                    measurements = self.extract_medical_measurements(text)
-                    return {
-                        "tests": measurements,
-                        "source": "voice"
-                    }
-                except sr.UnknownValueError:
-                    logger.error("Could not understand audio")
-                    return {"error": "Could not understand the audio. Please speak clearly and try again."}
-                except sr.RequestError as e:
-                    logger.error(f"Could not request results from Google Speech Recognition service: {e}")
-                    return {"error": f"Speech recognition service error: {str(e)}"}
-            except Exception as e:
-                logger.error(f"Error processing audio file: {str(e)}")
-                return {"error": f"Error processing audio: {str(e)}"}
+            if needs_conversion(audio_file_path):
+                audio_file_path = self.convert_to_wav(audio_file_path, temp_files)
+            return self.recognize_file(audio_file_path)
         finally:
             # Clean up temporary files
-            for temp_file in temp_files:
-                if os.path.exists(temp_file):
-                    try:
-                        os.unlink(temp_file)
-                        logger.info(f"Removed temporary file: {temp_file}")
-                    except Exception as e:
-                        logger.error(f"Error removing temporary file: {e}")
+            cleanup_temp_files(temp_files)
+
+    def convert_to_wav(self, audio_file_path, temp_files):
+        """
+        Convert an audio file to WAV with FFmpeg. The temporary WAV path is appended
+        to temp_files; on failure the original path is returned for direct processing.
+        """
+        try:
+            # Create temporary WAV file
+            wav_file = tempfile.NamedTemporaryFile(delete=False, suffix='.wav')
+            wav_file.close()
+            temp_files.append(wav_file.name)
+        except Exception as e:
+            logger.error(f"Error creating temporary file: {e}")
+            # Continue with original file
+            return audio_file_path
+
+        # Use FFmpeg to convert (if available)
+        try:
+            logger.info(f"Converting {audio_file_path} to WAV format at {wav_file.name}")
+            subprocess.run(
+                ffmpeg_command(audio_file_path, wav_file.name),
+                check=True,
+                capture_output=True
+            )
+            logger.info(f"Conversion successful")
+            return wav_file.name
+        except (subprocess.SubprocessError, FileNotFoundError) as e:
+            logger.error(f"FFmpeg conversion failed: {e}")
+            # If conversion fails, try direct processing
+            logger.info("Trying direct processing...")
+            return audio_file_path
+
+    def recognize_file(self, audio_file_path):
+        """Recognize speech in a WAV/AIFF/FLAC file and extract the measurements"""
+        recognizer = sr.Recognizer()
+        try:
+            logger.info(f"Opening audio file: {audio_file_path}")
+            with sr.AudioFile(audio_file_path) as source:
+                audio_data = recognizer.record(source)
+
+            try:
+                logger.info("Recognizing speech with Google...")
+                text = self.recognize_segmented(recognizer, audio_data)
+                logger.info(f"Recognized text: {text}")
+
+                # Extract medical measurements and add source information
+                measurements = self.extract_medical_measurements(text)
+                return {
+                    "tests": measurements,
+                    "source": "voice"
+                }
+            except sr.UnknownValueError:
+                logger.error("Could not understand audio")
+                return {"error": "Could not understand the audio. Please speak clearly and try again."}
+            except sr.RequestError as e:
+                logger.error(f"Could not request results from Google Speech Recognition service: {e}")
+                return {"error": f"Speech recognition service error: {str(e)}"}
+        except Exception as e:
+            logger.error(f"Error processing audio file: {str(e)}")
+            return {"error": f"Error processing audio: {str(e)}"}
+
+    def recognize_segmented(self, recognizer, audio_data):
+        """
+        Split the audio at pauses and recognize the segments concurrently.
+        The transcripts are joined in their original order.
+        """
+        pcm = audio_data.get_raw_data(convert_width=2)
+        segments = split_on_silence(pcm, audio_data.sample_rate,
+                                    energy_threshold=recognizer.energy_threshold,
+                                    max_segment_s=VOICE_MAX_SEGMENT_SECONDS)
+        if not segments:
+            # Nothing crossed the uncalibrated energy threshold (a quiet recording); send the whole clip instead
+            logger.info("No speech segments found, recognizing the whole clip")
+            segments = [pcm]
+        logger.info(f"Split audio into {len(segments)} segments")
+        segment_audio = [sr.AudioData(segment, audio_data.sample_rate, 2) for segment in segments]
+        texts = list(self.recognition_pool.map(
+            lambda audio: self.recognize_segment(recognizer, audio), segment_audio))
+        text = " ".join(t for t in texts if t)
+        if not text:
+            raise sr.UnknownValueError()
+        return text
+
+    def recognize_segment(self, recognizer, audio_data):
+        """
+        Recognize one segment, retrying it on its own after service errors.
+        Returns an empty string for segments without recognizable speech.
+        """
+        for attempt in range(VOICE_SEGMENT_RETRIES + 1):
+            try:
+                return recognizer.recognize_google(audio_data, language="en-US")
+            except sr.UnknownValueError:
+                return ""
+            except sr.RequestError as e:
+                if attempt == VOICE_SEGMENT_RETRIES:
+                    raise
+                logger.warning(f"Segment recognition failed (attempt {attempt + 1}), retrying: {e}")
+                time.sleep(0.5 * 2 ** attempt)
 
     def extract_medical_measurements(self, text):
         """Extract test names and values from transcribed text"""
@@ -0,0 +1,160 @@
+import os
+import hmac
+import time
+import uuid
+import random
+import marshal
+import cProfile
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+from flask import g, request, jsonify, abort, Response
+
+logger = logging.getLogger(__name__)
+
+# Off by default; when disabled no hooks are registered at all
+PROFILING_ENABLED = os.getenv('PROFILING_ENABLED', '').lower() in ('1', 'true', 'yes')
+# Fraction of requests profiled at random
+PROFILING_SAMPLE_RATE = float(os.getenv('PROFILING_SAMPLE_RATE', 0.01))
+# Requests carrying this header are always profiled
+PROFILING_HEADER = os.getenv('PROFILING_HEADER', 'X-Profile')
+# Number of most recent profiles kept in memory
+PROFILING_MAX_PROFILES = int(os.getenv('PROFILING_MAX_PROFILES', 50))
+# Comma-separated path prefixes eligible for profiling (empty means every path)
+PROFILING_PATHS = tuple(p for p in os.getenv('PROFILING_PATHS', '/image,/process_voice').split(',') if p)
+# Required: the profiling header and the download endpoints must carry this token
+PROFILING_TOKEN = os.getenv('PROFILING_TOKEN')
+
+
+class ProfileStore:
+    """Bounded, thread-safe store of the most recent request profiles."""
+
+    def __init__(self, max_profiles):
+        self._profiles = deque(maxlen=max_profiles)
+        self._lock = threading.Lock()
+
+    def add(self, metadata, data):
+        with self._lock:
+            self._profiles.append((metadata, data))
+
+    def list(self):
+        with self._lock:
+            return [metadata for metadata, _ in reversed(self._profiles)]
+
+    def get(self, profile_id):
+        with self._lock:
+            for metadata, data in self._profiles:
+                if metadata['id'] == profile_id:
+                    return metadata, data
+        return None
+
+
+# cProfile hooks are interpreter-wide on Python 3.12+, so only one request is profiled at a time
+_profiler_lock = threading.Lock()
+
+
+def start_request_profiler():
+    """Starts a profiler for this request unless another one is running. Returns it or None."""
+    if not _profiler_lock.acquire(blocking=False):
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        # Another profiling tool (a debugger or coverage) owns the hooks
+        _profiler_lock.release()
+        logger.info(f"Skipping request profile: {e}")
+        return None
+    return profiler
+
+
+def stop_request_profiler(profiler):
+    try:
+        profiler.disable()
+    finally:
+        _profiler_lock.release()
+
+
+def token_matches(value):
+    return value is not None and hmac.compare_digest(value.encode(), PROFILING_TOKEN.encode())
+
+
+def should_profile():
+    if PROFILING_PATHS and not request.path.startswith(PROFILING_PATHS):
+        return False
+    header = request.headers.get(PROFILING_HEADER)
+    if header is not None:
+        return token_matches(header)
+    return random.random() < PROFILING_SAMPLE_RATE
+
+
+def init_profiling(app, store=None):
+    """
+    Register the sampling profiler on a Flask app.
+
+    Sampled requests run under cProfile; the result is kept in the store in
+    the pstats format written by cProfile's dump_stats, so the downloads open
+    in pstats, snakeviz or gprof2dot. Profiles are listed at /_profiles and
+    downloaded from /_profiles/<id>.prof. Profiling stays off unless
+    PROFILING_TOKEN is set, since the endpoints expose code paths and timings.
+    """
+    if not PROFILING_ENABLED:
+        return None
+    if not PROFILING_TOKEN:
+        logger.error("PROFILING_ENABLED is set but PROFILING_TOKEN is not; request profiling stays disabled")
+        return None
+    store = store or ProfileStore(PROFILING_MAX_PROFILES)
+
+    @app.before_request
+    def start_profiler():
+        if should_profile():
+            profiler = start_request_profiler()
+            if profiler is not None:
+                g.profiler = profiler
+                g.profile_started = time.perf_counter()
+
+    @app.after_request
+    def store_profile(response):
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return response
+        stop_request_profiler(profiler)
+        profiler.create_stats()
+        metadata = {
+            'id': uuid.uuid4().hex,
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'duration_ms': round((time.perf_counter() - g.pop('profile_started')) * 1000, 1),
+            'timestamp': datetime.now().isoformat()
+        }
+        store.add(metadata, marshal.dumps(profiler.stats))
+        logger.info(f"Profiled {metadata['method']} {metadata['path']} in {metadata['duration_ms']} ms")
+        return response
+
+    @app.teardown_request
+    def stop_profiler(exc):
+        # Requests that failed before after_request still have to stop profiling their thread
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            stop_request_profiler(profiler)
+
+    @app.route("/_profiles")
+    def list_profiles():
+        if not token_matches(request.headers.get(PROFILING_HEADER)):
+            abort(403)
+        return jsonify({'profiles': store.list()})
+
+    @app.route("/_profiles/<profile_id>.prof")
+    def download_profile(profile_id):
+        if not token_matches(request.headers.get(PROFILING_HEADER)):
+            abort(403)
+        entry = store.get(profile_id)
+        if entry is None:
+            abort(404)
+        return Response(entry[1], mimetype='application/octet-stream',
+                        headers={'Content-Disposition': f'attachment; filename={profile_id}.prof'})
+
+    logger.info(f"Request profiling enabled (sample rate {PROFILING_SAMPLE_RATE}, header {PROFILING_HEADER})")
+    return store
@@ -0,0 +1,63 @@
+import logging
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import ConnectionFailure
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# collection -> list of (keys, options); creating an index that already exists is a no-op
+INDEXES = {
+    "users": [
+        ([("email", ASCENDING)], {"unique": True, "name": "email_unique"}),
+        ([("registration_id", ASCENDING)], {"unique": True, "name": "registration_id_unique"}),
+    ],
+    "reports": [
+        ([("user_id", ASCENDING), ("timestamp", DESCENDING)], {"name": "user_timestamp"}),
+        ([("import_key", ASCENDING)], {"unique": True, "sparse": True, "name": "import_key_unique"}),
+    ],
+    "analyte_series": [
+        ([("user_id", ASCENDING), ("analyte", ASCENDING)], {"unique": True, "name": "user_analyte_unique"}),
+    ],
+}
+
+
+def ensure_indexes(mongo_db):
+    """
+    Create the indexes the application relies on. Safe to call on every start.
+    A failing index (for example a unique index over existing duplicates) is
+    logged and the remaining indexes are still created; code that depends on
+    a unique index checks for it with has_index. When the server cannot be
+    reached the remaining indexes are skipped rather than each waiting for the
+    server selection timeout.
+    """
+    created = []
+    for collection, indexes in INDEXES.items():
+        for keys, options in indexes:
+            try:
+                created.append(mongo_db[collection].create_index(keys, **options))
+            except ConnectionFailure as e:
+                logger.error(f"Cannot reach MongoDB, skipping index creation: {e}")
+                return created
+            except Exception as e:
+                logger.error(f"Error creating index {options['name']} on {collection}: {e}")
+    logger.info(f"Ensured indexes: {', '.join(created)}")
+    return created
+
+
+# Indexes seen to exist, so callers that depend on one only pay for the lookup once
+_verified_indexes = set()
+
+
+def has_index(collection, name):
+    """Whether the named index exists on the collection. Positive answers are cached."""
+    key = (collection.full_name, name)
+    if key in _verified_indexes:
+        return True
+    try:
+        if name in collection.index_information():
+            _verified_indexes.add(key)
+            return True
+    except Exception as e:
+        logger.error(f"Error reading indexes of {collection.full_name}: {e}")
+    return False
@@ -46,6 +46,50 @@ if (dropArea && fileInput && fileNameDisplay) {
   });
 }
 
+// Hash-first upload: ask the server whether this exact file was already processed
+const uploadForm = document.getElementById('uploadForm');
+
+async function sha256Hex(file) {
+  const buffer = await file.arrayBuffer();
+  const hash = await crypto.subtle.digest('SHA-256', buffer);
+  return Array.from(new Uint8Array(hash))
+    .map(b => b.toString(16).padStart(2, '0'))
+    .join('');
+}
+
+// crypto.subtle is only available in secure contexts (HTTPS or localhost)
+if (uploadForm && fileInput && uploadForm.dataset.digestUrl && window.crypto && crypto.subtle) {
+  uploadForm.addEventListener('submit', async (e) => {
+    if (!fileInput.files || !fileInput.files[0]) {
+      return;
+    }
+    e.preventDefault();
+
+    try {
+      const formData = new FormData();
+      formData.append('digest', await sha256Hex(fileInput.files[0]));
+      const response = await fetch(uploadForm.dataset.digestUrl, {
+        method: 'POST',
+        body: formData
+      });
+      // 200 means the server already had a result and stored it for this user
+      if (response.status === 200 && !response.redirected) {
+        const html = await response.text();
+        document.open();
+        document.write(html);
+        document.close();
+        return;
+      }
+    } catch (error) {
+      console.error('Digest check failed, uploading file:', error);
+    }
+
+    // Unknown digest (204) or any failure: upload the file as usual.
+    // form.submit() does not fire the submit event again.
+    uploadForm.submit();
+  });
+}
+
 // Flash messages
 document.addEventListener('DOMContentLoaded', function() {
   // Automatically fade out flash messages after 5 seconds
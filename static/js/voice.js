@@ -8,6 +8,9 @@ const statusMessage = document.getElementById('statusMessage');
 const timerDisplay = document.getElementById('timer');
 const processingIndicator = document.getElementById('processingIndicator');
 const audioForm = document.getElementById('audioForm');
+const liveTranscript = document.getElementById('liveTranscript');
+const liveTranscriptText = document.getElementById('liveTranscriptText');
+const liveTests = document.getElementById('liveTests');
 
 // MediaRecorder variables
 let mediaRecorder;
@@ -15,6 +18,12 @@ let audioChunks = [];
 let startTime;
 let timerInterval;
 
+// Live streaming variables (only available when served by the async app)
+const STREAM_TIMESLICE_MS = 1000;
+let socket = null;
+let sentChunks = 0;
+let streamFinished = false;
+
 // Check if recording is supported
 if (navigator.mediaDevices && navigator.mediaDevices.getUserMedia) {
   // Setup is supported
@@ -46,14 +55,16 @@ async function startRecording() {
     }
 
     audioChunks = [];
+    openStream();
 
     // Event for data available
     mediaRecorder.addEventListener('dataavailable', event => {
       audioChunks.push(event.data);
+      sendPendingChunks();
     });
 
-    // Start recording
-    mediaRecorder.start();
+    // Start recording, emitting a chunk every second for the live stream
+    mediaRecorder.start(STREAM_TIMESLICE_MS);
 
     // Update UI to show recording state
     recordingIndicator.classList.add('active');
@@ -104,12 +115,100 @@ function stopRecording() {
       audio.src = audioURL;
       document.body.appendChild(audio);
 
-      // Submit the audio data with correct format
-      submitAudioData(audioBlob, mimeType);
+      // Finish the live stream if it is connected, otherwise upload the recording
+      if (socket && socket.readyState === WebSocket.OPEN) {
+        sendPendingChunks();
+        socket.send('stop');
+        socket.addEventListener('close', () => {
+          if (!streamFinished) {
+            submitAudioData(audioBlob, mimeType);
+          }
+        });
+      } else {
+        closeStream();
+        submitAudioData(audioBlob, mimeType);
+      }
     });
   }
 }
 
+// Open the live dictation socket; recording works without it
+function openStream() {
+  streamFinished = false;
+  sentChunks = 0;
+  if (!window.WebSocket) {
+    return;
+  }
+  const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+  try {
+    socket = new WebSocket(`${protocol}//${window.location.host}/ws/voice`);
+  } catch (error) {
+    console.log("Live dictation not available:", error);
+    socket = null;
+    return;
+  }
+  socket.addEventListener('open', sendPendingChunks);
+  socket.addEventListener('message', handleStreamMessage);
+  socket.addEventListener('error', () => {
+    console.log("Live dictation not available, the recording will be uploaded instead");
+  });
+}
+
+function closeStream() {
+  if (socket) {
+    socket.close();
+    socket = null;
+  }
+}
+
+// Send the chunks recorded since the last send (including those recorded before the socket opened)
+function sendPendingChunks() {
+  if (!socket || socket.readyState !== WebSocket.OPEN) {
+    return;
+  }
+  while (sentChunks < audioChunks.length) {
+    socket.send(audioChunks[sentChunks]);
+    sentChunks++;
+  }
+}
+
+function handleStreamMessage(event) {
+  const message = JSON.parse(event.data);
+  if (message.type === 'partial') {
+    showLiveResults(message.transcript, message.tests);
+  } else if (message.type === 'final') {
+    streamFinished = true;
+    document.open();
+    document.write(message.html);
+    document.close();
+  } else if (message.type === 'error') {
+    streamFinished = true;
+    closeStream();
+    statusMessage.textContent = message.error;
+    processingIndicator.classList.add('hidden');
+    startButton.disabled = false;
+  }
+}
+
+function showLiveResults(transcript, tests) {
+  liveTranscript.classList.remove('hidden');
+  liveTranscriptText.textContent = transcript;
+  liveTests.innerHTML = '';
+  Object.entries(tests || {}).forEach(([test, value]) => {
+    const item = document.createElement('div');
+    item.className = 'test-item';
+    const name = document.createElement('span');
+    name.className = 'test-name';
+    name.textContent = test;
+    const val = document.createElement('span');
+    val.className = 'test-value';
+    val.textContent = value;
+    item.appendChild(name);
+    item.appendChild(val);
+    liveTests.appendChild(item);
+  });
+}
+
 // Update the timer display
 function updateTimer() {
   const elapsedTime = Date.now() - startTime;
@@ -142,6 +241,12 @@ function submitAudioData(audioBlob, mimeType) {
     body: formData
   })
   .then(response => {
+    if (response.status === 429) {
+      const retryAfter = response.headers.get('Retry-After') || 'a few';
+      const error = new Error('The server is busy. Please try again in ' + retryAfter + ' seconds.');
+      error.busy = true;
+      throw error;
+    }
     if (!response.ok) {
       throw new Error('Server error: ' + response.status);
     }
@@ -155,7 +260,7 @@ function submitAudioData(audioBlob, mimeType) {
   })
   .catch(error => {
     console.error('Error:', error);
-    statusMessage.textContent = 'Error processing recording. Please try again.';
+    statusMessage.textContent = error.busy ? error.message : 'Error processing recording. Please try again.';
     processingIndicator.classList.add('hidden');
     startButton.disabled = false;
   });